@@ -1,10 +1,13 @@
 from pymongo import MongoClient
 from datetime import datetime
-from bson import ObjectId
+from functools import cached_property
+from summary_context import SummaryContext
+import storage
 
 # MongoDB connection
 client = MongoClient("mongodb://localhost:27017/")
 db = client["finance_manager"]
+backend = storage.from_env(db)
 
 class FinanceManager:
     @staticmethod
@@ -14,137 +17,87 @@ class FinanceManager:
             "email": email,
             "password": password  # In a real app, ensure this is hashed
         }
-        result = db.users.insert_one(user)
-        return str(result.inserted_id)
+        return backend.create_user(user)
 
     @staticmethod
     def add_income(user_id: str, amount: float, source: str, date: datetime):
         income = {
-            "user_id": ObjectId(user_id),
             "amount": amount,
             "source": source,
             "date": date
         }
-        db.incomes.insert_one(income)
+        backend.add_income(user_id, income)
 
     @staticmethod
     def add_expense(user_id: str, amount: float, category: str, date: datetime):
         expense = {
-            "user_id": ObjectId(user_id),
             "amount": amount,
             "category": category,
             "date": date
         }
-        db.expenses.insert_one(expense)
+        backend.add_expense(user_id, expense)
 
     @staticmethod
     def add_loan(user_id: str, amount: float, interest_rate: float, lender: str, start_date: datetime, end_date: datetime):
         loan = {
-            "user_id": ObjectId(user_id),
             "amount": amount,
             "interest_rate": interest_rate,
             "lender": lender,
             "start_date": start_date,
             "end_date": end_date
         }
-        db.loans.insert_one(loan)
+        backend.add_loan(user_id, loan)
 
     @staticmethod
     def add_investment(user_id: str, amount: float, return_rate: float, name: str, start_date: datetime, end_date: datetime = None):
         investment = {
-            "user_id": ObjectId(user_id),
             "amount": amount,
             "return_rate": return_rate,
             "name": name,
             "start_date": start_date,
             "end_date": end_date
         }
-        db.investments.insert_one(investment)
+        backend.add_investment(user_id, investment)
 
     @staticmethod
     def get_monthly_income(user_id: str, month: int, year: int):
-        start_date = datetime(year, month, 1)
-        end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-        pipeline = [
-            {"$match": {
-                "user_id": ObjectId(user_id),
-                "date": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.incomes.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_monthly_income(user_id, month, year)
 
     @staticmethod
     def get_monthly_expenses(user_id: str, month: int, year: int):
-        start_date = datetime(year, month, 1)
-        end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-        pipeline = [
-            {"$match": {
-                "user_id": ObjectId(user_id),
-                "date": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.expenses.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_monthly_expenses(user_id, month, year)
 
     @staticmethod
     def get_loans(user_id: str):
-        pipeline = [
-            {"$match": {"user_id": ObjectId(user_id)}},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.loans.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_loans(user_id)
 
     @staticmethod
     def get_investments(user_id: str):
-        pipeline = [
-            {"$match": {"user_id": ObjectId(user_id)}},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.investments.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_investments(user_id)
 
     @staticmethod
     def categorize_expenses(user_id: str, month: int, year: int):
-        start_date = datetime(year, month, 1)
-        end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-        pipeline = [
-            {"$match": {
-                "user_id": ObjectId(user_id),
-                "date": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {"_id": "$category", "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.expenses.aggregate(pipeline))
-        return {item["_id"]: item["total"] for item in result}
+        return backend.categorize_expenses(user_id, month, year)
+
+    @staticmethod
+    def get_monthly_loan_interest(user_id: str):
+        return backend.get_monthly_loan_interest(user_id)
+
+    @staticmethod
+    def get_monthly_investment_returns(user_id: str):
+        return backend.get_monthly_investment_returns(user_id)
 
     @staticmethod
     def calculate_net_return(user_id: str, month: int, year: int):
-        income = FinanceManager.get_monthly_income(user_id, month, year)
-        expenses = FinanceManager.get_monthly_expenses(user_id, month, year)
-        
-        # Calculate loan interest
-        loans = list(db.loans.find({"user_id": ObjectId(user_id)}))
-        loan_interest = sum(loan["amount"] * (loan["interest_rate"] / 12) for loan in loans)
-        
-        # Calculate investment returns
-        investments = list(db.investments.find({"user_id": ObjectId(user_id)}))
-        investment_returns = sum(inv["amount"] * (inv["return_rate"] / 12) for inv in investments)
-        
-        return income - expenses - loan_interest + investment_returns
+        return FinanceSummary(user_id, month, year).net_return
 
     @staticmethod
     def project_yearly_trend(user_id: str, month: int, year: int):
-        monthly_net_return = FinanceManager.calculate_net_return(user_id, month, year)
-        return monthly_net_return * 12
+        return FinanceSummary(user_id, month, year).yearly_projection
     
     @staticmethod
     def calculate_min_profit_to_avoid_loss(user_id: str, month: int, year: int):
-        yearly_expenses = FinanceManager.get_monthly_expenses(user_id, month, year) * 12
-        return yearly_expenses / 12
+        return FinanceSummary(user_id, month, year).min_profit_to_avoid_loss
     
     def get_user_input():
         print("Welcome to the Finance Manager!")
@@ -195,35 +148,43 @@ class FinanceManager:
         return user_id, month, year
 
     def display_summary(user_id, month, year):
-        # Get financial summary
-        income = FinanceManager.get_monthly_income(user_id, month, year)
-        expenses = FinanceManager.get_monthly_expenses(user_id, month, year)
-        loans = FinanceManager.get_loans(user_id)
-        investments = FinanceManager.get_investments(user_id)
-        
+        # Every figure below is read from one summary context, so each
+        # underlying query runs at most once
+        summary = FinanceSummary(user_id, month, year)
+
         print(f"\nFinancial Summary for {month}/{year}")
-        print(f"Monthly Income: ${income}")
-        print(f"Monthly Expenses: ${expenses}")
-        print(f"Total Loans: ${loans}")
-        print(f"Total Investments: ${investments}")
+        print(f"Monthly Income: ${summary.income}")
+        print(f"Monthly Expenses: ${summary.expenses}")
+        print(f"Total Loans: ${summary.loans}")
+        print(f"Total Investments: ${summary.investments}")
 
         # Calculate net return
-        net_return = FinanceManager.calculate_net_return(user_id, month, year)
-        print(f"Net Return: ${net_return}")
+        print(f"Net Return: ${summary.net_return}")
 
         # Project yearly trend
-        yearly_trend = FinanceManager.project_yearly_trend(user_id, month, year)
-        print(f"Yearly Projection: ${yearly_trend}")
+        print(f"Yearly Projection: ${summary.yearly_projection}")
 
         # Get expense categories
-        categories = FinanceManager.categorize_expenses(user_id, month, year)
         print("Expense Categories:")
-        for category, amount in categories.items():
+        for category, amount in summary.expense_categories.items():
             print(f"  {category}: ${amount}")
 
         # Calculate minimum profit to avoid loss
-        min_profit = FinanceManager.calculate_min_profit_to_avoid_loss(user_id, month, year)
-        print(f"Minimum Monthly Profit to Avoid Loss: ${min_profit}")
+        print(f"Minimum Monthly Profit to Avoid Loss: ${summary.min_profit_to_avoid_loss}")
+
+class FinanceSummary(SummaryContext):
+    # Summary context for the CLI: net return uses monthly loan interest and
+    # investment returns rather than the raw totals
+    def __init__(self, user_id: str, month: int, year: int):
+        super().__init__(FinanceManager, user_id, month, year)
+
+    @cached_property
+    def loan_payments(self):
+        return FinanceManager.get_monthly_loan_interest(self.user_id)
+
+    @cached_property
+    def investment_returns(self):
+        return FinanceManager.get_monthly_investment_returns(self.user_id)
 
 # Example usage:
 if __name__ == "__main__":
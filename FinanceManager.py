@@ -22,6 +22,7 @@ import os
 from dotenv import load_dotenv
 import os
 import uvicorn
+import storage
 
 # Load environment variables from .env file
 load_dotenv()
@@ -44,6 +45,8 @@ else:
 # MongoDB connection
 client = MongoClient(os.getenv("MONGODB_URI"))
 db = client["finance_manager"]
+# User ids stay plain strings here, as this entry point has always stored them
+backend = storage.from_env(db, object_ids=False)
 
 try:
     # Attempt to list database names to check connection
@@ -98,84 +101,40 @@ class DatabaseOperations:
     @staticmethod
     def add_income(user_id: str, income: Income):
         # Add a new income entry to the database
-        db.incomes.insert_one({"user_id": user_id, **income.model_dump()})
+        backend.add_income(user_id, income.model_dump())
 
     @staticmethod
     def add_expense(user_id: str, expense: Expense):
         # Add a new expense entry to the database
-        db.expenses.insert_one({"user_id": user_id, **expense.model_dump()})
+        backend.add_expense(user_id, expense.model_dump())
 
     @staticmethod
     def add_loan(user_id: str, loan: Loan):
         # Add a new loan entry to the database
-        db.loans.insert_one({"user_id": user_id, **loan.model_dump()})
+        backend.add_loan(user_id, loan.model_dump())
 
     @staticmethod
     def add_investment(user_id: str, investment: Investment):
         # Add a new investment entry to the database
-        db.investments.insert_one({"user_id": user_id, **investment.model_dump()})
+        backend.add_investment(user_id, investment.model_dump())
 
     @staticmethod
     def get_monthly_income(user_id: str, month: int, year: int):
         # Retrieve total income for a specific month and year
-        pipeline = [
-            {
-            "$match": {
-                "user_id": user_id,
-                "date": {
-                "$gte": datetime(year, month, 1),
-                "$lt": datetime(year, month + 1, 1)
-                }
-            }
-            },
-            {
-            "$group": {
-                "_id": None,
-                "total_income": {
-                "$sum": "$amount"
-                }
-            }
-            }
-        ]
-        result = db.incomes.aggregate(pipeline)
-        total_income = result.next()["total_income"]
-        return total_income
+        return backend.get_monthly_income(user_id, month, year)
 
     @staticmethod
     def get_monthly_expenses(user_id: str, month: int, year: int):
-        pipeline = [
-            {
-            "$match": {
-                "user_id": user_id,
-                "date": {
-                "$gte": datetime(year, month, 1),
-                "$lt": datetime(year, month + 1, 1)
-                }
-            }
-            },
-            {
-            "$group": {
-                "_id": None,
-                "total_expenses": {
-                "$sum": "$amount"
-                }
-            }
-            }
-        ]
-        result = db.expenses.aggregate(pipeline)
-        total_expenses = result.next()["total_expenses"]
-        return total_expenses
+        return backend.get_monthly_expenses(user_id, month, year)
 
     @staticmethod
     def get_loans(user_id: str):
         # Retrieve all active loans for a user
-        active_loans = db.loans.find({"user_id": user_id, "end_date": {"$gte": datetime.now()}})
-        return list(active_loans)
+        return backend.get_holdings("loans", user_id, active_on=datetime.now())
 
     @staticmethod
     def get_investments(user_id: str):
-        active_investments = db.investments.find({"user_id": user_id, "end_date": {"$gte": datetime.now()}})
-        return list(active_investments)
+        return backend.get_holdings("investments", user_id, active_on=datetime.now())
 
 # Financial calculations
 class FinancialCalculations:
@@ -213,7 +172,7 @@ class FinancialCalculations:
 @app.post("/user/create")
 async def create_user(user: User):
     # Create a new user account
-    db.users.insert_one(user.model_dump())
+    backend.create_user(user.model_dump())
     return {"message": "User created successfully"}
 
 @app.post("/income/add")
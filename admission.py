@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+# Admission control for the API. Every route runs its database work inside
+# `controller.admit(route_class, user_id)`, which bounds how many requests use
+# the MongoDB connection pool at once:
+#   - a fixed number of slots is shared by all route classes, and each class
+#     may only hold up to its own limit. A number of reserved slots can only
+#     be used by the top-priority class (writes), so reads and summaries
+#     together can never take every slot
+#   - requests that cannot start queue in priority order (writes first) in a
+#     bounded queue, and are shed with 503 + Retry-After when the queue is
+#     full or their deadline passes
+#   - per-user token buckets cap how fast one client may start requests of a
+#     class, answering 429 + Retry-After when exhausted
+
+
+class Shed(Exception):
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class RouteClass:
+    def __init__(self, priority: int, limit: int, deadline: float, rate: float = None, burst: int = None):
+        self.priority = priority  # lower runs first
+        self.limit = limit        # max concurrently admitted requests of this class
+        self.deadline = deadline  # max seconds spent queued before shedding
+        self.rate = rate          # per-user tokens per second (None = unlimited)
+        self.burst = burst        # per-user bucket size
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        # Returns 0 when a token was taken, otherwise the seconds until one is available
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float):
+        # A full bucket behaves exactly like a new one, so it can be dropped
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class AdmissionController:
+    # Token buckets are swept for idle users whenever their number doubles
+    MIN_BUCKET_SWEEP = 1024
+
+    def __init__(self, capacity: int, max_queue: int, route_classes: dict, reserved: int = 0):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.route_classes = route_classes
+        self.reserved = reserved
+        self.top_priority = min(route_class.priority for route_class in route_classes.values())
+        self.active = {name: 0 for name in route_classes}
+        self.waiters = []  # [priority, sequence, route class name, future]
+        self.sequence = 0
+        self.buckets = {}
+        self.bucket_sweep_at = self.MIN_BUCKET_SWEEP
+        self.admitted = {name: 0 for name in route_classes}
+        self.shed = {name: {} for name in route_classes}
+
+    def _can_start(self, name: str):
+        route_class = self.route_classes[name]
+        if sum(self.active.values()) >= self.capacity or self.active[name] >= route_class.limit:
+            return False
+        if route_class.priority == self.top_priority:
+            return True
+        shared = sum(
+            active for other, active in self.active.items()
+            if self.route_classes[other].priority != self.top_priority
+        )
+        return shared < self.capacity - self.reserved
+
+    def _shed(self, name: str, status_code: int, retry_after: float, reason: str):
+        self.shed[name][reason] = self.shed[name].get(reason, 0) + 1
+        return Shed(status_code, retry_after, reason)
+
+    def _release(self, name: str):
+        self.active[name] -= 1
+        # Hand freed slots to the highest-priority waiters that fit
+        for waiter in sorted(self.waiters):
+            if waiter[3].done():
+                # Timed out or cancelled, not yet removed by its own task
+                self.waiters.remove(waiter)
+            elif self._can_start(waiter[2]):
+                self.waiters.remove(waiter)
+                self.active[waiter[2]] += 1
+                waiter[3].set_result(None)
+
+    def _forget(self, waiter):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+
+    def _granted(self, waiter):
+        # _release() hands over a slot by setting the future's result; a
+        # waiter that stops waiting right after must give that slot back
+        future = waiter[3]
+        return future.done() and not future.cancelled() and future.exception() is None
+
+    def _sweep_buckets(self):
+        now = time.monotonic()
+        for key in [key for key, bucket in self.buckets.items() if bucket.is_full(now)]:
+            del self.buckets[key]
+        self.bucket_sweep_at = max(self.MIN_BUCKET_SWEEP, 2 * len(self.buckets))
+
+    @asynccontextmanager
+    async def admit(self, name: str, user_id: str = None):
+        route_class = self.route_classes[name]
+
+        if route_class.rate is not None and user_id is not None:
+            bucket = self.buckets.get((name, user_id))
+            if bucket is None:
+                if len(self.buckets) >= self.bucket_sweep_at:
+                    self._sweep_buckets()
+                bucket = self.buckets[name, user_id] = TokenBucket(route_class.rate, route_class.burst)
+            wait = bucket.take()
+            if wait:
+                raise self._shed(name, 429, wait, "rate_limited")
+
+        # Waiters left in the queue could not start when the last slot was
+        # released, so only same-class waiters (FIFO) take precedence here
+        if self._can_start(name) and not any(waiter[2] == name for waiter in self.waiters):
+            self.active[name] += 1
+        else:
+            if len(self.waiters) >= self.max_queue:
+                # A full queue sheds its least important waiter if the new
+                # request outranks it, otherwise the new request
+                worst = max(self.waiters)
+                if worst[0] <= route_class.priority:
+                    raise self._shed(name, 503, route_class.deadline, "queue_full")
+                self.waiters.remove(worst)
+                if not worst[3].done():
+                    worst_class = self.route_classes[worst[2]]
+                    worst[3].set_exception(self._shed(worst[2], 503, worst_class.deadline, "evicted"))
+            self.sequence += 1
+            waiter = [route_class.priority, self.sequence, name, asyncio.get_running_loop().create_future()]
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter[3], route_class.deadline)
+            except asyncio.TimeoutError:
+                # The slot may have been granted as the deadline passed
+                if self._granted(waiter):
+                    self._release(name)
+                self._forget(waiter)
+                raise self._shed(name, 503, route_class.deadline, "deadline")
+            except asyncio.CancelledError:
+                # Client went away; give the slot back if it was granted meanwhile
+                if self._granted(waiter):
+                    self._release(name)
+                self._forget(waiter)
+                raise
+
+        self.admitted[name] += 1
+        try:
+            yield
+        finally:
+            self._release(name)
+
+    def metrics(self):
+        return {
+            "capacity": self.capacity,
+            "reserved": self.reserved,
+            "active": dict(self.active),
+            "queue_depth": {
+                name: sum(1 for waiter in self.waiters if waiter[2] == name) for name in self.route_classes
+            },
+            "admitted": dict(self.admitted),
+            "shed": {name: dict(reasons) for name, reasons in self.shed.items()}
+        }
+
+
+def from_env():
+    # A quarter of the slots is reserved for writes; reads and summaries share
+    # the rest and may each hold at most three quarters of all slots
+    capacity = int(os.environ.get("ADMISSION_CAPACITY", 16))
+    summary_limit = int(os.environ.get("ADMISSION_SUMMARY_LIMIT", capacity * 3 // 4))
+    return AdmissionController(
+        capacity=capacity,
+        max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 64)),
+        reserved=int(os.environ.get("ADMISSION_WRITE_RESERVED", max(1, capacity // 4))),
+        route_classes={
+            "write": RouteClass(priority=0, limit=capacity, deadline=10.0),
+            "read": RouteClass(priority=1, limit=summary_limit, deadline=5.0),
+            "summary": RouteClass(
+                priority=2,
+                limit=summary_limit,
+                deadline=float(os.environ.get("ADMISSION_SUMMARY_DEADLINE", 2.0)),
+                rate=float(os.environ.get("ADMISSION_SUMMARY_RATE", 2.0)),
+                burst=int(os.environ.get("ADMISSION_SUMMARY_BURST", 10))
+            )
+        }
+    )
@@ -0,0 +1,190 @@
+import os
+import zlib
+from datetime import datetime
+
+import bson
+
+import buckets
+import versions
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Cold-data tiering: closed months past the retention window are moved out of
+# the hot incomes/expenses collections into one compact document per
+# (user_id, kind, year, month). The document keeps the aggregate totals in
+# plain fields, so summaries never touch the payload, and the transactions
+# themselves in a compressed BSON blob that is only unpacked for row access.
+ARCHIVE_COLLECTION = "transaction_archive"
+
+# Number of closed months kept in the hot collections
+RETENTION_MONTHS = int(os.environ.get("ARCHIVE_RETENTION_MONTHS", 12))
+
+
+def ensure_indexes(db):
+    db[ARCHIVE_COLLECTION].create_index(
+        [("user_id", 1), ("kind", 1), ("year", 1), ("month", 1)], unique=True
+    )
+
+
+def compress(transactions: list):
+    payload = bson.encode({"transactions": transactions})
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor().compress(payload)
+    return "zlib", zlib.compress(payload, 9)
+
+
+def decompress(codec: str, blob: bytes):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this archive")
+        payload = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        payload = zlib.decompress(blob)
+    return bson.decode(payload)["transactions"]
+
+
+def month_range(month: int, year: int):
+    start_date = datetime(year, month, 1)
+    end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
+    return start_date, end_date
+
+
+def is_closed(month: int, year: int, now: datetime = None):
+    # Only months that have fully ended can have been archived
+    now = now or datetime.now()
+    return (year, month) < (now.year, now.month)
+
+
+def cutoff(retention_months: int = RETENTION_MONTHS, now: datetime = None):
+    # First day of the oldest month that stays hot
+    now = now or datetime.now()
+    index = now.year * 12 + now.month - 1 - retention_months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def archive_query(kind: str, user_id, month: int, year: int):
+    return {"user_id": user_id, "kind": kind, "year": year, "month": month}
+
+
+def get_totals(db, kind: str, user_id, month: int, year: int):
+    return db[ARCHIVE_COLLECTION].find_one(
+        archive_query(kind, user_id, month, year),
+        {"total": 1, "count": 1, "categories": 1, "_id": 0}
+    )
+
+
+def get_category_totals(db, kind: str, user_id, month: int, year: int):
+    archived = get_totals(db, kind, user_id, month, year)
+    if not archived:
+        return {}
+    return {buckets.category_name(key): amount for key, amount in archived.get("categories", {}).items()}
+
+
+def get_transactions(db, kind: str, user_id, month: int, year: int):
+    archived = db[ARCHIVE_COLLECTION].find_one(
+        archive_query(kind, user_id, month, year),
+        {"codec": 1, "blob": 1, "_id": 0}
+    )
+    if not archived:
+        return []
+    return decompress(archived["codec"], archived["blob"])
+
+
+def closed_months(db, kind: str, before: datetime, bucketed: bool = False):
+    # Distinct (user_id, year, month) keys in the hot collection older than `before`
+    if bucketed:
+        pipeline = [
+            {"$match": {"$or": [
+                {"year": {"$lt": before.year}},
+                {"year": before.year, "month": {"$lt": before.month}}
+            ]}},
+            {"$group": {"_id": {"user_id": "$user_id", "year": "$year", "month": "$month"}}}
+        ]
+        collection = db[buckets.BUCKET_COLLECTIONS[kind]]
+    else:
+        pipeline = [
+            {"$match": {"date": {"$lt": before}}},
+            {"$group": {"_id": {
+                "user_id": "$user_id",
+                "year": {"$year": "$date"},
+                "month": {"$month": "$date"}
+            }}}
+        ]
+        collection = db[kind]
+    for item in collection.aggregate(pipeline, allowDiskUse=True):
+        yield item["_id"]["user_id"], item["_id"]["year"], item["_id"]["month"]
+
+
+def archive_month(db, kind: str, user_id, month: int, year: int, bucketed: bool = False):
+    # Only the documents read here are deleted afterwards, so a write that
+    # lands while the month is being archived stays in the hot collection.
+    # Buckets are closed first: later writes open a new bucket instead of
+    # appending to one that is about to be deleted.
+    if bucketed:
+        hot = db[buckets.BUCKET_COLLECTIONS[kind]]
+        key = {"user_id": user_id, "year": year, "month": month}
+        hot.update_many(key, {"$set": {"closed": True}})
+        hot_docs = list(hot.find({**key, "closed": True}, {"transactions": 1}))
+    else:
+        start_date, end_date = month_range(month, year)
+        hot = db[kind]
+        hot_docs = list(hot.find(
+            {"user_id": user_id, "date": {"$gte": start_date, "$lt": end_date}}, {"user_id": 0}
+        ))
+    if not hot_docs:
+        return 0
+
+    # The archive records which hot documents it is merging until they are
+    # deleted, so a run that dies in between does not merge them twice
+    existing = db[ARCHIVE_COLLECTION].find_one(archive_query(kind, user_id, month, year), {"sources": 1})
+    merged = set(existing.get("sources", [])) if existing else set()
+    new_docs = [doc for doc in hot_docs if doc["_id"] not in merged]
+    if bucketed:
+        transactions = [transaction for bucket in new_docs for transaction in bucket["transactions"]]
+    else:
+        transactions = [{key: value for key, value in doc.items() if key != "_id"} for doc in new_docs]
+    moved = len(transactions)
+
+    if new_docs:
+        # Merge with anything archived earlier for the same month (late writes)
+        transactions = get_transactions(db, kind, user_id, month, year) + transactions
+        categories = {}
+        for transaction in transactions:
+            if "category" in transaction:
+                key = buckets.category_key(transaction["category"])
+                categories[key] = categories.get(key, 0) + transaction["amount"]
+        codec, blob = compress(transactions)
+        archived = {
+            "user_id": user_id,
+            "kind": kind,
+            "year": year,
+            "month": month,
+            "count": len(transactions),
+            "total": sum(transaction["amount"] for transaction in transactions),
+            "codec": codec,
+            "blob": bson.Binary(blob),
+            "sources": [doc["_id"] for doc in hot_docs]
+        }
+        if categories:
+            archived["categories"] = categories
+        db[ARCHIVE_COLLECTION].replace_one(
+            archive_query(kind, user_id, month, year), archived, upsert=True
+        )
+    hot.delete_many({"_id": {"$in": [doc["_id"] for doc in hot_docs]}})
+    db[ARCHIVE_COLLECTION].update_one(archive_query(kind, user_id, month, year), {"$unset": {"sources": ""}})
+    versions.bump(db, user_id)
+    return moved
+
+
+def archive_closed_months(db, retention_months: int = RETENTION_MONTHS, bucketed: bool = False):
+    ensure_indexes(db)
+    before = cutoff(retention_months)
+    archived = {}
+    for kind in buckets.BUCKET_COLLECTIONS:
+        archived[kind] = 0
+        for user_id, year, month in list(closed_months(db, kind, before, bucketed)):
+            archived[kind] += archive_month(db, kind, user_id, month, year, bucketed)
+    return archived
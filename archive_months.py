@@ -0,0 +1,25 @@
+import argparse
+import os
+
+from pymongo import MongoClient
+
+import archive
+
+# Moves closed months older than the retention window from the hot
+# incomes/expenses collections into the compressed archive. Safe to run
+# repeatedly, e.g. nightly from cron.
+#   python archive_months.py [--retention-months N]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old incomes and expenses into monthly snapshots")
+    parser.add_argument("--retention-months", type=int, default=archive.RETENTION_MONTHS,
+                        help="number of closed months to keep in the hot collections")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
+    db = client["finance_manager"]
+    bucketed = os.environ.get("STORAGE_LAYOUT", "document") == "bucket"
+    archived = archive.archive_closed_months(db, args.retention_months, bucketed)
+    for kind, count in archived.items():
+        print(f"Archived {count} {kind}")
+    client.close()
@@ -0,0 +1,92 @@
+from dates import to_naive_utc
+
+# Bucket-pattern storage: instead of one document per transaction, each
+# (user_id, year, month) gets one document holding a bounded array of
+# transactions plus running totals. A month with more than BUCKET_SIZE
+# transactions simply spills into another bucket with the same key.
+BUCKET_SIZE = 500
+
+# Bucketed collections, keyed by the per-transaction collection they replace
+BUCKET_COLLECTIONS = {"incomes": "income_buckets", "expenses": "expense_buckets"}
+
+
+def category_key(category: str) -> str:
+    # Category names become field names inside "categories", so the
+    # characters MongoDB reserves in field names are swapped for look-alikes
+    return category.replace("$", "＄").replace(".", "．")
+
+
+def category_name(key: str) -> str:
+    return key.replace("＄", "$").replace("．", ".")
+
+
+def ensure_indexes(db):
+    for name in BUCKET_COLLECTIONS.values():
+        db[name].create_index([("user_id", 1), ("year", 1), ("month", 1), ("count", 1)])
+
+
+def add_transaction(collection, user_id, transaction: dict):
+    # Append to the open bucket for the transaction's month, creating a new
+    # one when every existing bucket is full or closed for archiving. The
+    # bucket is picked by the UTC month, the month every other layout uses.
+    date = to_naive_utc(transaction["date"])
+    transaction = {**transaction, "date": date}
+    amount = transaction["amount"]
+    inc = {"count": 1, "total": amount}
+    if "category" in transaction:
+        inc["categories." + category_key(transaction["category"])] = amount
+    collection.update_one(
+        {"user_id": user_id, "year": date.year, "month": date.month, "count": {"$lt": BUCKET_SIZE},
+         "closed": {"$ne": True}},
+        {"$push": {"transactions": transaction}, "$inc": inc},
+        upsert=True
+    )
+
+
+def monthly_total_pipeline(user_id, month: int, year: int):
+    return [
+        {"$match": {"user_id": user_id, "year": year, "month": month}},
+        {"$group": {"_id": None, "total": {"$sum": "$total"}}}
+    ]
+
+
+def monthly_total(collection, user_id, month: int, year: int):
+    result = list(collection.aggregate(monthly_total_pipeline(user_id, month, year)))
+    return result[0]["total"] if result else 0
+
+
+def category_totals(collection, user_id, month: int, year: int):
+    totals = {}
+    buckets = collection.find(
+        {"user_id": user_id, "year": year, "month": month},
+        {"categories": 1, "_id": 0}
+    )
+    for bucket in buckets:
+        for key, amount in bucket.get("categories", {}).items():
+            name = category_name(key)
+            totals[name] = totals.get(name, 0) + amount
+    return totals
+
+
+def build_buckets(user_id, year: int, month: int, transactions: list):
+    # Turn one month of transactions into ready-to-insert bucket documents
+    buckets = []
+    for start in range(0, len(transactions), BUCKET_SIZE):
+        chunk = transactions[start:start + BUCKET_SIZE]
+        categories = {}
+        for transaction in chunk:
+            if "category" in transaction:
+                key = category_key(transaction["category"])
+                categories[key] = categories.get(key, 0) + transaction["amount"]
+        bucket = {
+            "user_id": user_id,
+            "year": year,
+            "month": month,
+            "count": len(chunk),
+            "total": sum(transaction["amount"] for transaction in chunk),
+            "transactions": chunk
+        }
+        if categories:
+            bucket["categories"] = categories
+        buckets.append(bucket)
+    return buckets
@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.son import SON
+from pymongo import MongoClient
+
+import archive
+import buckets
+import daily_index
+import recurring
+import storage
+import versions
+
+# Query-plan regression check. Seeds a scratch database on a local mongod,
+# creates the indexes through MongoBackend.ensure_indexes(), then runs
+# explain("executionStats") on every query the API depends on and fails when
+#   - the winning plan contains a COLLSCAN or no index scan at all, or
+#   - documents examined / documents the query needs exceeds --max-docs-ratio
+# The exit status is non-zero on any failure, so it can gate a test run.
+#   python check_query_plans.py [--max-docs-ratio 1.5] [--json]
+
+SEED_DATABASE = "finance_manager_plan_check"
+SEED_USERS = 20
+SEED_MONTHS = 12
+SEED_PER_MONTH = 30
+SEED_START = datetime(2023, 1, 1)
+
+INDEX_STAGES = ("IXSCAN", "EXPRESS_IXSCAN", "IDHACK", "DISTINCT_SCAN", "COUNT_SCAN")
+
+
+def seed(db):
+    # A dozen months of data for a score of users, in every layout and tier,
+    # so a missing index shows up as documents examined for other users/months
+    db.client.drop_database(db.name)
+    storage.MongoBackend(db, bucketed=True).ensure_indexes()
+    rng = random.Random(0)
+    categories = ["rent", "food", "transport", "fun", "utilities"]
+
+    user_ids = [ObjectId() for _ in range(SEED_USERS)]
+    for user_id in user_ids:
+        transactions = {"incomes": [], "expenses": []}
+        for index in range(SEED_MONTHS):
+            month_start = datetime(SEED_START.year + index // 12, index % 12 + 1, 1)
+            for _ in range(SEED_PER_MONTH):
+                date = month_start + timedelta(days=rng.randrange(28), hours=rng.randrange(24))
+                transactions["incomes"].append({"amount": rng.uniform(10, 500), "source": "salary", "date": date})
+                transactions["expenses"].append({"amount": rng.uniform(1, 200), "category": rng.choice(categories), "date": date})
+
+        for kind, rows in transactions.items():
+            db[kind].insert_many([{**row, "user_id": user_id} for row in rows])
+            for index in range(SEED_MONTHS):
+                year, month = SEED_START.year + index // 12, index % 12 + 1
+                month_rows = [row for row in rows if (row["date"].year, row["date"].month) == (year, month)]
+                db[buckets.BUCKET_COLLECTIONS[kind]].insert_many(buckets.build_buckets(user_id, year, month, month_rows))
+                codec, blob = archive.compress(month_rows)
+                db[archive.ARCHIVE_COLLECTION].insert_one({
+                    **archive.archive_query(kind, user_id, month, year - 1),
+                    "count": len(month_rows),
+                    "total": sum(row["amount"] for row in month_rows),
+                    "codec": codec,
+                    "blob": blob
+                })
+        daily_index.rebuild(db, user_id, transactions)
+
+        for name in ("loans", "investments"):
+            db[name].insert_many([
+                {"user_id": user_id, "amount": rng.uniform(1000, 10000), "interest_rate": 0.05, "return_rate": 0.04,
+                 "start_date": SEED_START, "end_date": SEED_START + timedelta(days=3650)}
+                for _ in range(3)
+            ])
+        db[recurring.RULES_COLLECTION].insert_many([
+            {"user_id": user_id, "kind": kind, "amount": 100.0, "frequency": "monthly", "interval": 1,
+             "start_date": SEED_START, "end_date": None}
+            for kind in ("incomes", "expenses")
+        ])
+        # The global counter was created by daily_index.rebuild() above
+        db[versions.VERSIONS_COLLECTION].insert_many([
+            {"user_id": user_id, "month_key": key, "version": 1}
+            for key in versions.month_keys(SEED_START, SEED_START + timedelta(days=365))
+        ])
+    return user_ids
+
+
+def checks(user_id):
+    # (name, collection, explain command, filter used to count the documents the query needs)
+    backend = storage.MongoBackend(None)
+    user = str(user_id)
+    month, year = 6, SEED_START.year
+    start_date, end_date = archive.month_range(month, year)
+
+    def aggregate(collection, pipeline):
+        return collection, {"aggregate": collection, "pipeline": pipeline, "cursor": {}}, pipeline[0]["$match"]
+
+    def find(collection, query, sort=None, limit=0):
+        command = {"find": collection, "filter": query, "limit": limit}
+        if sort:
+            command["sort"] = SON(sort)
+        return collection, command, None
+
+    cumulative_query, cumulative_sort = daily_index.cumulative_query(user_id, end_date)
+    rules_query = {**recurring.rules_filter(user_id, start_date, end_date), "kind": "expenses"}
+    return [
+        ("get_monthly_income", *aggregate("incomes", backend.monthly_total_pipeline(user, month, year))),
+        ("get_monthly_expenses", *aggregate("expenses", backend.monthly_total_pipeline(user, month, year))),
+        ("categorize_expenses", *aggregate("expenses", backend.category_totals_pipeline(user, month, year))),
+        ("get_loans", *aggregate("loans", backend.holdings_total_pipeline(user))),
+        ("get_investments", *aggregate("investments", backend.holdings_total_pipeline(user))),
+        ("bucketed monthly total", *aggregate("income_buckets", buckets.monthly_total_pipeline(user_id, month, year))),
+        ("daily index lookup", *find(daily_index.DAILY_COLLECTION, cumulative_query, cumulative_sort, limit=1)),
+        ("archived month totals", *find(archive.ARCHIVE_COLLECTION, archive.archive_query("expenses", user_id, month, year - 1))),
+        ("recurring rules", *find(recurring.RULES_COLLECTION, rules_query)),
+        ("write versions", *find(versions.VERSIONS_COLLECTION, backend.version_query(user, [versions.month_key(year, month)]))),
+    ]
+
+
+def find_key(node, key):
+    # First value stored under `key` anywhere in an explain document
+    if isinstance(node, dict):
+        if key in node:
+            return node[key]
+        node = list(node.values())
+    if isinstance(node, list):
+        for item in node:
+            found = find_key(item, key)
+            if found is not None:
+                return found
+    return None
+
+
+def plan_stages(node):
+    stages = []
+    if isinstance(node, dict):
+        if isinstance(node.get("stage"), str):
+            stages.append(node["stage"])
+        node = list(node.values())
+    if isinstance(node, list):
+        for item in node:
+            stages.extend(plan_stages(item))
+    return stages
+
+
+def check_plan(db, name, collection, command, needed_filter, max_docs_ratio):
+    explained = db.command("explain", command, verbosity="executionStats")
+    stages = plan_stages(find_key(explained, "winningPlan"))
+    stats = find_key(explained, "executionStats") or {}
+    docs_examined = stats.get("totalDocsExamined", 0)
+    # Aggregations return grouped rows, so compare against the documents
+    # their $match selects; finds are compared against what they return
+    if needed_filter is not None:
+        needed = db[collection].count_documents(needed_filter)
+    else:
+        needed = stats.get("nReturned", 0)
+    ratio = docs_examined / max(needed, 1)
+
+    problems = []
+    if "COLLSCAN" in stages:
+        problems.append("COLLSCAN")
+    if not any(stage in INDEX_STAGES for stage in stages):
+        problems.append("no index scan")
+    if ratio > max_docs_ratio:
+        problems.append(f"docs examined ratio {ratio:.2f} > {max_docs_ratio}")
+    return {
+        "name": name,
+        "collection": collection,
+        "stages": stages,
+        "keys_examined": stats.get("totalKeysExamined", 0),
+        "docs_examined": docs_examined,
+        "docs_needed": needed,
+        "docs_ratio": round(ratio, 2),
+        "ok": not problems,
+        "problems": problems
+    }
+
+
+def run_checks(db, max_docs_ratio: float = 1.5):
+    user_ids = seed(db)
+    return [
+        check_plan(db, name, collection, command, needed_filter, max_docs_ratio)
+        for name, collection, command, needed_filter in checks(user_ids[SEED_USERS // 2])
+    ]
+
+
+def format_report(results):
+    lines = [f"{'query':<24} {'collection':<20} {'keys':>6} {'docs':>6} {'needed':>6} {'ratio':>6}  result"]
+    for result in results:
+        status = "ok" if result["ok"] else "FAIL: " + ", ".join(result["problems"])
+        lines.append(
+            f"{result['name']:<24} {result['collection']:<20} {result['keys_examined']:>6} "
+            f"{result['docs_examined']:>6} {result['docs_needed']:>6} {result['docs_ratio']:>6}  {status}"
+        )
+        lines.append(f"{'':<24} plan: {' <- '.join(result['stages'])}")
+    failed = sum(1 for result in results if not result["ok"])
+    lines.append(f"{len(results) - failed} passed, {failed} failed")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that every query plan uses an index")
+    parser.add_argument("--max-docs-ratio", type=float, default=1.5,
+                        help="maximum documents examined per document the query needs")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
+    try:
+        results = run_checks(client[SEED_DATABASE], args.max_docs_ratio)
+        client.drop_database(SEED_DATABASE)
+    finally:
+        client.close()
+    print(json.dumps(results, indent=2) if args.json else format_report(results))
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
@@ -0,0 +1,123 @@
+import threading
+from datetime import datetime, timedelta
+
+import buckets
+import versions
+from dates import to_naive_utc
+
+# Prefix-sum index: one document per user and day holding the running totals
+# of income, expenses and per-category spend up to and including that day.
+# The total over any date range is then the difference of two cumulative
+# lookups, whatever the length of the range.
+DAILY_COLLECTION = "daily_totals"
+
+FIELDS = {"incomes": "income", "expenses": "expenses"}
+
+# Writes to one user's index are serialized within the process (the API
+# runs as one process with a threadpool): a new day is seeded from the
+# previous day's totals, and a backdated write running between that read and
+# the insert would otherwise be missing from the new day. A fixed set of
+# locks, picked by user, bounds the memory used whatever the number of users.
+LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def ensure_indexes(db):
+    db[DAILY_COLLECTION].create_index([("user_id", 1), ("day", -1)], unique=True)
+
+
+def day_of(date: datetime):
+    # Days are UTC days, like the months every layout files transactions under
+    date = to_naive_utc(date)
+    return datetime(date.year, date.month, date.day)
+
+
+def cumulative_query(user_id, before: datetime):
+    # Filter and sort selecting the latest day strictly before `before`
+    return {"user_id": user_id, "day": {"$lt": before}}, [("day", -1)]
+
+
+def cumulative(db, user_id, before: datetime):
+    # Running totals over every day strictly before `before`
+    query, sort = cumulative_query(user_id, before)
+    latest = db[DAILY_COLLECTION].find_one(
+        query, {"_id": 0, "income": 1, "expenses": 1, "categories": 1}, sort=sort
+    )
+    return latest or {}
+
+
+def record(db, user_id, kind: str, transaction: dict):
+    # Add one transaction to the index. Appending to the latest day touches a
+    # single document; a backdated write also shifts every later day.
+    collection = db[DAILY_COLLECTION]
+    day = day_of(transaction["date"])
+    inc = {FIELDS[kind]: transaction["amount"]}
+    if "category" in transaction:
+        inc["categories." + buckets.category_key(transaction["category"])] = transaction["amount"]
+    with LOCKS[hash(user_id) % len(LOCKS)]:
+        previous = cumulative(db, user_id, day)
+        collection.update_one(
+            {"user_id": user_id, "day": day},
+            {"$setOnInsert": {
+                "income": previous.get("income", 0),
+                "expenses": previous.get("expenses", 0),
+                "categories": previous.get("categories", {})
+            }},
+            upsert=True
+        )
+        collection.update_many({"user_id": user_id, "day": {"$gte": day}}, {"$inc": inc})
+
+
+def range_totals(db, user_id, start: datetime, end: datetime):
+    # Totals for the days in [start, end)
+    upper = cumulative(db, user_id, day_of(end))
+    lower = cumulative(db, user_id, day_of(start))
+    categories = {}
+    lower_categories = lower.get("categories", {})
+    for key, amount in upper.get("categories", {}).items():
+        spent = amount - lower_categories.get(key, 0)
+        if spent:
+            categories[buckets.category_name(key)] = spent
+    return {
+        "income": upper.get("income", 0) - lower.get("income", 0),
+        "expenses": upper.get("expenses", 0) - lower.get("expenses", 0),
+        "expense_categories": categories
+    }
+
+
+def rebuild(db, user_id, transactions_by_kind: dict):
+    # Recreate a user's index from scratch. `transactions_by_kind` maps
+    # "incomes"/"expenses" to iterables of transaction dicts.
+    daily = {}
+    for kind, transactions in transactions_by_kind.items():
+        for transaction in transactions:
+            totals = daily.setdefault(day_of(transaction["date"]), {"income": 0, "expenses": 0, "categories": {}})
+            totals[FIELDS[kind]] += transaction["amount"]
+            if "category" in transaction:
+                key = buckets.category_key(transaction["category"])
+                totals["categories"][key] = totals["categories"].get(key, 0) + transaction["amount"]
+
+    running = {"income": 0, "expenses": 0, "categories": {}}
+    documents = []
+    for day in sorted(daily):
+        running["income"] += daily[day]["income"]
+        running["expenses"] += daily[day]["expenses"]
+        for key, amount in daily[day]["categories"].items():
+            running["categories"][key] = running["categories"].get(key, 0) + amount
+        documents.append({
+            "user_id": user_id,
+            "day": day,
+            "income": running["income"],
+            "expenses": running["expenses"],
+            "categories": dict(running["categories"])
+        })
+
+    db[DAILY_COLLECTION].delete_many({"user_id": user_id})
+    if documents:
+        db[DAILY_COLLECTION].insert_many(documents)
+    # Range summaries read the index, so cached ones are stale now
+    versions.bump(db, user_id)
+    return len(documents)
+
+
+def next_day(date: datetime):
+    return day_of(date) + timedelta(days=1)
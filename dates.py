@@ -0,0 +1,9 @@
+from datetime import datetime, timezone
+
+
+def to_naive_utc(date: datetime):
+    # MongoDB stores datetimes as naive UTC, and so do the NumPy columns and
+    # the bucket keys; tz-aware input is converted before it is filed
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
@@ -79,16 +79,30 @@ if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
     '''
 
-from fastapi import FastAPI, HTTPException, Path
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Path, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Literal, Optional
 from datetime import datetime
 from pymongo import MongoClient
 import os
-from bson import ObjectId
+import math
+from summary_context import SummaryContext
+from archive import month_range
+import daily_index
+import recurring
+import storage
+import admission
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(backend.ensure_indexes)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -99,10 +113,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Admission control (see admission.py): route database work runs in the
+# threadpool under a bounded, prioritized number of slots
+limiter = admission.from_env()
+
 # MongoDB connection
 client = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
 db = client["finance_manager"]
 
+# Storage backend (see storage.py): MongoDB by default, STORAGE_BACKEND=memory
+# for the in-memory columnar engine, STORAGE_LAYOUT=bucket for bucketed Mongo
+backend = storage.from_env(db)
+
 # Models
 class Income(BaseModel):
     amount: float
@@ -128,6 +150,21 @@ class Investment(BaseModel):
     start_date: datetime
     end_date: Optional[datetime]
 
+class RecurringRule(BaseModel):
+    kind: Literal["incomes", "expenses"]
+    amount: float
+    frequency: Literal["daily", "weekly", "monthly", "yearly"]
+    interval: int = Field(1, ge=1)
+    start_date: datetime
+    end_date: Optional[datetime] = None
+    source: Optional[str] = None
+    category: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_dates(self):
+        recurring.validate(self.model_dump())
+        return self
+
 class User(BaseModel):
     username: str
     email: str
@@ -137,79 +174,87 @@ class User(BaseModel):
 class DatabaseOperations:
     @staticmethod
     def create_user(user: User):
-        user_dict = user.dict()
-        result = db.users.insert_one(user_dict)
-        return str(result.inserted_id)
+        return backend.create_user(user.dict())
 
     @staticmethod
     def add_income(user_id: str, income: Income):
-        income_dict = income.dict()
-        income_dict["user_id"] = ObjectId(user_id)
-        db.incomes.insert_one(income_dict)
+        backend.add_income(user_id, income.dict())
 
     @staticmethod
     def add_expense(user_id: str, expense: Expense):
-        expense_dict = expense.dict()
-        expense_dict["user_id"] = ObjectId(user_id)
-        db.expenses.insert_one(expense_dict)
+        backend.add_expense(user_id, expense.dict())
 
     @staticmethod
     def add_loan(user_id: str, loan: Loan):
-        loan_dict = loan.dict()
-        loan_dict["user_id"] = ObjectId(user_id)
-        db.loans.insert_one(loan_dict)
+        backend.add_loan(user_id, loan.dict())
 
     @staticmethod
     def add_investment(user_id: str, investment: Investment):
-        investment_dict = investment.dict()
-        investment_dict["user_id"] = ObjectId(user_id)
-        db.investments.insert_one(investment_dict)
+        backend.add_investment(user_id, investment.dict())
 
     @staticmethod
     def get_monthly_income(user_id: str, month: int, year: int):
-        start_date = datetime(year, month, 1)
-        end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-        pipeline = [
-            {"$match": {
-                "user_id": ObjectId(user_id),
-                "date": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.incomes.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_monthly_income(user_id, month, year)
 
     @staticmethod
     def get_monthly_expenses(user_id: str, month: int, year: int):
-        start_date = datetime(year, month, 1)
-        end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-        pipeline = [
-            {"$match": {
-                "user_id": ObjectId(user_id),
-                "date": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.expenses.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_monthly_expenses(user_id, month, year)
+
+    @staticmethod
+    def get_etag(user_id: str, start_date: datetime, end_date: datetime):
+        return backend.get_etag(user_id, start_date, end_date)
+
+    @staticmethod
+    def get_range_totals(user_id: str, start_date: datetime, end_date: datetime):
+        return backend.get_range_totals(user_id, start_date, end_date)
+
+    @staticmethod
+    def get_financial_summary(user_id: str, month: int, year: int):
+        summary = SummaryContext(DatabaseOperations, user_id, month, year)
+        return {
+            "net_return": summary.net_return,
+            "yearly_projection": summary.yearly_projection,
+            "min_profit_to_avoid_loss": summary.min_profit_to_avoid_loss,
+            "expense_categories": summary.expense_categories
+        }
+
+    @staticmethod
+    def get_range_summary(user_id: str, start_date: datetime, end_date: datetime):
+        totals = DatabaseOperations.get_range_totals(user_id, start_date, end_date)
+        return {
+            "income": totals["income"],
+            "expenses": totals["expenses"],
+            "net_savings": totals["income"] - totals["expenses"],
+            "expense_categories": totals["expense_categories"]
+        }
+
+    @staticmethod
+    def add_recurring_rule(user_id: str, rule: RecurringRule):
+        return backend.add_recurring_rule(user_id, rule.dict())
+
+    @staticmethod
+    def skip_recurring_occurrence(user_id: str, rule_id: str, date: datetime):
+        return backend.skip_recurring_occurrence(user_id, rule_id, date)
+
+    @staticmethod
+    def override_recurring_occurrence(user_id: str, rule_id: str, date: datetime, amount: float):
+        return backend.override_recurring_occurrence(user_id, rule_id, date, amount)
+
+    @staticmethod
+    def get_monthly_transactions(kind: str, user_id: str, month: int, year: int):
+        return backend.get_monthly_transactions(kind, user_id, month, year)
+
+    @staticmethod
+    def categorize_expenses(user_id: str, month: int, year: int):
+        return backend.categorize_expenses(user_id, month, year)
 
     @staticmethod
     def get_loans(user_id: str):
-        pipeline = [
-            {"$match": {"user_id": ObjectId(user_id)}},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.loans.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_loans(user_id)
 
     @staticmethod
     def get_investments(user_id: str):
-        pipeline = [
-            {"$match": {"user_id": ObjectId(user_id)}},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.investments.aggregate(pipeline))
-        return result[0]["total"] if result else 0
+        return backend.get_investments(user_id)
 
 # Financial Calculations
 class FinancialCalculations:
@@ -227,96 +272,208 @@ class FinancialCalculations:
 
     @staticmethod
     def categorize_expenses(user_id: str, month: int, year: int):
-        start_date = datetime(year, month, 1)
-        end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-        pipeline = [
-            {"$match": {
-                "user_id": ObjectId(user_id),
-                "date": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {"_id": "$category", "total": {"$sum": "$amount"}}}
-        ]
-        result = list(db.expenses.aggregate(pipeline))
-        return {item["_id"]: item["total"] for item in result}
+        return backend.categorize_expenses(user_id, month, year)
+
+def etag_matches(request: Request, etag: str):
+    # If-None-Match may hold several (possibly weak) ETags or "*"
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+async def check_etag(request: Request, response: Response, user_id: str, start_date: datetime, end_date: datetime):
+    # The version lookup is admitted as a cheap read, so polling clients get
+    # their 304 without queueing behind summaries. It is read before the data,
+    # so a concurrent write can only make the ETag older than the body.
+    async with limiter.admit("read"):
+        try:
+            etag = await run_in_threadpool(DatabaseOperations.get_etag, user_id, start_date, end_date)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    response.headers["ETag"] = etag
+    return etag_matches(request, etag)
+
+@app.exception_handler(admission.Shed)
+async def shed_request(request: Request, exc: admission.Shed):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": "Server busy, retry later" if exc.status_code == 503 else "Too many requests"},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))}
+    )
 
 # API Routes
 @app.post("/user/create")
 async def create_user(user: User):
-    try:
-        user_id = DatabaseOperations.create_user(user)
-        return {"message": "User created successfully", "user_id": user_id}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    async with limiter.admit("write"):
+        try:
+            user_id = await run_in_threadpool(DatabaseOperations.create_user, user)
+            return {"message": "User created successfully", "user_id": user_id}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/user/{user_id}/income/add")
 async def add_income(
     income: Income,
     user_id: str = Path(..., title="The ID of the user to add income for")
 ):
-    try:
-        DatabaseOperations.add_income(user_id, income)
-        return {"message": "Income added successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    async with limiter.admit("write"):
+        try:
+            await run_in_threadpool(DatabaseOperations.add_income, user_id, income)
+            return {"message": "Income added successfully"}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/user/{user_id}/expense/add")
 async def add_expense(
     expense: Expense,
     user_id: str = Path(..., title="The ID of the user to add expense for")
 ):
-    try:
-        DatabaseOperations.add_expense(user_id, expense)
-        return {"message": "Expense added successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    async with limiter.admit("write"):
+        try:
+            await run_in_threadpool(DatabaseOperations.add_expense, user_id, expense)
+            return {"message": "Expense added successfully"}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/user/{user_id}/loan/add")
 async def add_loan(
     loan: Loan,
     user_id: str = Path(..., title="The ID of the user to add loan for")
 ):
-    try:
-        DatabaseOperations.add_loan(user_id, loan)
-        return {"message": "Loan added successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    async with limiter.admit("write"):
+        try:
+            await run_in_threadpool(DatabaseOperations.add_loan, user_id, loan)
+            return {"message": "Loan added successfully"}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/user/{user_id}/investment/add")
 async def add_investment(
     investment: Investment,
     user_id: str = Path(..., title="The ID of the user to add investment for")
 ):
-    try:
-        DatabaseOperations.add_investment(user_id, investment)
-        return {"message": "Investment added successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    async with limiter.admit("write"):
+        try:
+            await run_in_threadpool(DatabaseOperations.add_investment, user_id, investment)
+            return {"message": "Investment added successfully"}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/user/{user_id}/recurring/add")
+async def add_recurring_rule(
+    rule: RecurringRule,
+    user_id: str = Path(..., title="The ID of the user to add the recurring rule for")
+):
+    async with limiter.admit("write"):
+        try:
+            rule_id = await run_in_threadpool(DatabaseOperations.add_recurring_rule, user_id, rule)
+            return {"message": "Recurring rule added successfully", "rule_id": rule_id}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/user/{user_id}/recurring/{rule_id}/skip")
+async def skip_recurring_occurrence(
+    user_id: str = Path(..., title="The ID of the user owning the rule"),
+    rule_id: str = Path(..., title="The ID of the recurring rule"),
+    date: datetime = Query(..., title="The date of the occurrence to skip")
+):
+    async with limiter.admit("write"):
+        try:
+            if not await run_in_threadpool(DatabaseOperations.skip_recurring_occurrence, user_id, rule_id, date):
+                raise ValueError("Recurring rule not found")
+            return {"message": "Occurrence skipped successfully"}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/user/{user_id}/recurring/{rule_id}/override")
+async def override_recurring_occurrence(
+    user_id: str = Path(..., title="The ID of the user owning the rule"),
+    rule_id: str = Path(..., title="The ID of the recurring rule"),
+    date: datetime = Query(..., title="The date of the occurrence to override"),
+    amount: float = Query(..., title="The amount to use for that occurrence")
+):
+    async with limiter.admit("write"):
+        try:
+            if not await run_in_threadpool(DatabaseOperations.override_recurring_occurrence, user_id, rule_id, date, amount):
+                raise ValueError("Recurring rule not found")
+            return {"message": "Occurrence overridden successfully"}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/user/{user_id}/incomes")
+async def list_incomes(
+    request: Request,
+    response: Response,
+    user_id: str = Path(..., title="The ID of the user to list incomes for"),
+    month: int = Query(..., ge=1, le=12, title="The month to list incomes for"),
+    year: int = Query(..., ge=1, le=9998, title="The year to list incomes for")
+):
+    if await check_etag(request, response, user_id, *month_range(month, year)):
+        return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+    async with limiter.admit("read", user_id):
+        try:
+            return await run_in_threadpool(DatabaseOperations.get_monthly_transactions, "incomes", user_id, month, year)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/user/{user_id}/expenses")
+async def list_expenses(
+    request: Request,
+    response: Response,
+    user_id: str = Path(..., title="The ID of the user to list expenses for"),
+    month: int = Query(..., ge=1, le=12, title="The month to list expenses for"),
+    year: int = Query(..., ge=1, le=9998, title="The year to list expenses for")
+):
+    if await check_etag(request, response, user_id, *month_range(month, year)):
+        return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+    async with limiter.admit("read", user_id):
+        try:
+            return await run_in_threadpool(DatabaseOperations.get_monthly_transactions, "expenses", user_id, month, year)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/user/{user_id}/financial-summary")
 async def get_financial_summary(
+    request: Request,
+    response: Response,
     user_id: str = Path(..., title="The ID of the user to get financial summary for"),
-    month: int = Path(..., title="The month to get summary for"),
-    year: int = Path(..., title="The year to get summary for")
+    month: int = Query(..., ge=1, le=12, title="The month to get summary for"),
+    year: int = Query(..., ge=1, le=9998, title="The year to get summary for")
 ):
-    try:
-        income = DatabaseOperations.get_monthly_income(user_id, month, year)
-        expenses = DatabaseOperations.get_monthly_expenses(user_id, month, year)
-        loans = DatabaseOperations.get_loans(user_id)
-        investments = DatabaseOperations.get_investments(user_id)
-
-        net_return = FinancialCalculations.calculate_net_return(income, expenses, loans, investments)
-        yearly_projection = FinancialCalculations.project_yearly_trend(net_return)
-        min_profit = FinancialCalculations.calculate_min_profit_to_avoid_loss(expenses * 12)
-        expense_categories = FinancialCalculations.categorize_expenses(user_id, month, year)
-
-        return {
-            "net_return": net_return,
-            "yearly_projection": yearly_projection,
-            "min_profit_to_avoid_loss": min_profit,
-            "expense_categories": expense_categories
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    if await check_etag(request, response, user_id, *month_range(month, year)):
+        return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+    async with limiter.admit("summary", user_id):
+        try:
+            return await run_in_threadpool(DatabaseOperations.get_financial_summary, user_id, month, year)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/user/{user_id}/range-summary")
+async def get_range_summary(
+    request: Request,
+    response: Response,
+    user_id: str = Path(..., title="The ID of the user to get the summary for"),
+    start: datetime = Query(..., title="First day of the range"),
+    end: datetime = Query(..., title="Last day of the range (inclusive)")
+):
+    # Whole UTC days, so every backend sums exactly the same transactions
+    start = daily_index.day_of(start)
+    end = daily_index.next_day(end)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if await check_etag(request, response, user_id, start, end):
+        return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+    async with limiter.admit("summary", user_id):
+        try:
+            return await run_in_threadpool(DatabaseOperations.get_range_summary, user_id, start, end)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/metrics")
+async def get_metrics():
+    # Admission control state: active slots, queue depth and shed counts per route class
+    return limiter.metrics()
 
 if __name__ == "__main__":
     import uvicorn
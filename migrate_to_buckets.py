@@ -0,0 +1,63 @@
+import argparse
+import os
+from itertools import groupby
+
+from pymongo import MongoClient
+
+import buckets
+import versions
+
+# Builds the bucketed collections from the per-transaction incomes/expenses
+# collections. Run it once before switching the API to STORAGE_LAYOUT=bucket;
+# it refuses to run once the bucketed collections hold data, as those may
+# contain writes made through the API since the switch.
+#   python migrate_to_buckets.py [--delete-source]
+
+
+def migrate_collection(db, source: str, delete_source: bool = False):
+    target = db[buckets.BUCKET_COLLECTIONS[source]]
+    if target.find_one({}, {"_id": 1}) is not None:
+        raise RuntimeError(f"{target.name} is not empty, refusing to migrate {source} into it")
+    buckets.ensure_indexes(db)
+
+    migrated = 0
+    user_ids = set()
+    cursor = db[source].find({}).sort([("user_id", 1), ("date", 1)])
+    for (user_id, year, month), group in groupby(
+        cursor, key=lambda doc: (doc["user_id"], doc["date"].year, doc["date"].month)
+    ):
+        transactions = []
+        source_ids = []
+        for doc in group:
+            source_ids.append(doc.pop("_id"))
+            del doc["user_id"]
+            transactions.append(doc)
+        target.insert_many(buckets.build_buckets(user_id, year, month, transactions))
+        # Only the documents just migrated are removed; anything inserted
+        # since the cursor read them stays in place
+        if delete_source:
+            db[source].delete_many({"_id": {"$in": source_ids}})
+        migrated += len(transactions)
+        user_ids.add(user_id)
+
+    for user_id in user_ids:
+        versions.bump(db, user_id)
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate incomes and expenses to the bucketed layout")
+    parser.add_argument("--delete-source", action="store_true",
+                        help="remove the per-transaction documents once migrated")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
+    db = client["finance_manager"]
+    try:
+        for source in buckets.BUCKET_COLLECTIONS:
+            count = migrate_collection(db, source, args.delete_source)
+            print(f"Migrated {count} {source} into {buckets.BUCKET_COLLECTIONS[source]}")
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+    finally:
+        client.close()
@@ -0,0 +1,50 @@
+import os
+
+from pymongo import MongoClient
+
+import archive
+import buckets
+import daily_index
+
+# Builds the daily prefix-sum index for existing data. New writes keep it up
+# to date on their own, so this only needs to run once (or after a restore).
+# Reads the layout selected by STORAGE_LAYOUT, like the API.
+#   python rebuild_daily_index.py
+
+
+def hot_collection(kind: str, bucketed: bool):
+    return buckets.BUCKET_COLLECTIONS[kind] if bucketed else kind
+
+
+def user_transactions(db, kind: str, user_id, bucketed: bool = False):
+    # Every transaction of a user in the active layout and in the archive.
+    # The other layout is ignored: migrate_to_buckets.py keeps its source
+    # documents unless asked not to, so both may hold the same transactions.
+    if bucketed:
+        for bucket in db[buckets.BUCKET_COLLECTIONS[kind]].find({"user_id": user_id}, {"transactions": 1}):
+            yield from bucket["transactions"]
+    else:
+        yield from db[kind].find({"user_id": user_id}, {"_id": 0, "user_id": 0})
+    for archived in db[archive.ARCHIVE_COLLECTION].find(
+        {"user_id": user_id, "kind": kind}, {"codec": 1, "blob": 1}
+    ):
+        yield from archive.decompress(archived["codec"], archived["blob"])
+
+
+if __name__ == "__main__":
+    client = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
+    db = client["finance_manager"]
+    daily_index.ensure_indexes(db)
+    bucketed = os.environ.get("STORAGE_LAYOUT", "document") == "bucket"
+
+    user_ids = set()
+    for kind in buckets.BUCKET_COLLECTIONS:
+        user_ids.update(db[hot_collection(kind, bucketed)].distinct("user_id"))
+    user_ids.update(db[archive.ARCHIVE_COLLECTION].distinct("user_id"))
+
+    for user_id in user_ids:
+        days = daily_index.rebuild(db, user_id, {
+            kind: user_transactions(db, kind, user_id, bucketed) for kind in buckets.BUCKET_COLLECTIONS
+        })
+        print(f"Indexed {days} days for user {user_id}")
+    client.close()
@@ -0,0 +1,123 @@
+from datetime import datetime
+
+import numpy as np
+
+# Recurring incomes/expenses (rent, salary, subscriptions) are stored once as
+# a rule and expanded into occurrences only when a summary, range or listing
+# asks for a window. Expansion is done on NumPy datetime64[D] arrays, so a
+# rule costs the same to evaluate for a month as for a decade.
+RULES_COLLECTION = "recurring_rules"
+
+FREQUENCIES = ("daily", "weekly", "monthly", "yearly")
+
+# Field each kind of rule must carry, as Income and Expense require them
+REQUIRED_FIELDS = {"incomes": "source", "expenses": "category"}
+
+
+def ensure_indexes(db):
+    db[RULES_COLLECTION].create_index([("user_id", 1), ("kind", 1), ("start_date", 1)])
+
+
+def to_day(date: datetime):
+    return np.datetime64(date.date(), "D")
+
+
+def validate(rule: dict):
+    # Rules are expanded on every read, so a rule that cannot be expanded is
+    # rejected when stored rather than failing every later summary
+    if rule["kind"] not in REQUIRED_FIELDS:
+        raise ValueError(f"kind must be one of {', '.join(REQUIRED_FIELDS)}")
+    if not rule.get(REQUIRED_FIELDS[rule["kind"]]):
+        raise ValueError(f"{rule['kind']} rules need a {REQUIRED_FIELDS[rule['kind']]}")
+    if rule["frequency"] not in FREQUENCIES:
+        raise ValueError(f"frequency must be one of {', '.join(FREQUENCIES)}")
+    if rule.get("interval", 1) < 1:
+        raise ValueError("interval must be at least 1")
+    if rule.get("end_date") is not None and to_day(rule["end_date"]) < to_day(rule["start_date"]):
+        raise ValueError("end_date must not be before start_date")
+
+
+def rules_filter(user_id, start_date: datetime, end_date: datetime):
+    # Rules that can have an occurrence in [start_date, end_date)
+    return {
+        "user_id": user_id,
+        "start_date": {"$lt": end_date},
+        "$or": [{"end_date": None}, {"end_date": {"$gte": start_date}}]
+    }
+
+
+def occurrence_dates(rule: dict, start_date: datetime, end_date: datetime):
+    first = to_day(rule["start_date"])
+    low = max(to_day(start_date), first)
+    high = to_day(end_date)
+    if rule.get("end_date") is not None:
+        high = min(high, to_day(rule["end_date"]) + 1)
+    if low >= high:
+        return np.array([], dtype="datetime64[D]")
+
+    interval = rule.get("interval", 1)
+    if rule["frequency"] in ("daily", "weekly"):
+        step = interval * (7 if rule["frequency"] == "weekly" else 1)
+        skipped = -(-(low - first).astype(int) // step)
+        return np.arange(first + skipped * step, high, step)
+
+    # Monthly and yearly rules keep the day of month of the first occurrence,
+    # clamped to the length of shorter months (e.g. the 31st -> Feb 28th)
+    step = interval * (12 if rule["frequency"] == "yearly" else 1)
+    first_month = first.astype("datetime64[M]")
+    day = (first - first_month.astype("datetime64[D]")).astype(int)
+    skipped = (low.astype("datetime64[M]") - first_month).astype(int) // step
+    months = np.arange(first_month + skipped * step, high.astype("datetime64[M]") + 1, step)
+    month_starts = months.astype("datetime64[D]")
+    month_lengths = ((months + 1).astype("datetime64[D]") - month_starts).astype(int)
+    dates = month_starts + np.minimum(day, month_lengths - 1)
+    return dates[(dates >= low) & (dates < high)]
+
+
+def expand(rule: dict, start_date: datetime, end_date: datetime):
+    # Occurrence dates and amounts of one rule in [start_date, end_date),
+    # with skipped occurrences removed and overridden amounts applied
+    dates = occurrence_dates(rule, start_date, end_date)
+    if rule.get("skips"):
+        dates = dates[~np.isin(dates, np.array([to_day(skip) for skip in rule["skips"]]))]
+    amounts = np.full(len(dates), rule["amount"], dtype=float)
+    if rule.get("overrides") and len(dates):
+        override_dates = np.array(list(rule["overrides"]), dtype="datetime64[D]")
+        override_amounts = np.array(list(rule["overrides"].values()), dtype=float)
+        positions = np.minimum(np.searchsorted(dates, override_dates), len(dates) - 1)
+        matched = dates[positions] == override_dates
+        amounts[positions[matched]] = override_amounts[matched]
+    return dates, amounts
+
+
+def total(rules, start_date: datetime, end_date: datetime):
+    return float(sum(expand(rule, start_date, end_date)[1].sum() for rule in rules))
+
+
+def category_totals(rules, start_date: datetime, end_date: datetime):
+    totals = {}
+    for rule in rules:
+        amount = expand(rule, start_date, end_date)[1].sum()
+        if amount:
+            totals[rule.get("category")] = totals.get(rule.get("category"), 0) + float(amount)
+    return totals
+
+
+def transactions(rules, start_date: datetime, end_date: datetime):
+    # Materialize occurrences as transaction dicts, for listings only
+    rows = []
+    for rule in rules:
+        dates, amounts = expand(rule, start_date, end_date)
+        for date, amount in zip(dates.tolist(), amounts.tolist()):
+            row = {"amount": amount, "date": datetime(date.year, date.month, date.day), "recurring_rule_id": str(rule["_id"])}
+            for field in ("source", "category"):
+                if rule.get(field) is not None:
+                    row[field] = rule[field]
+            rows.append(row)
+    rows.sort(key=lambda row: row["date"])
+    return rows
+
+
+def override_key(date: datetime):
+    return "overrides." + date.strftime("%Y-%m-%d")
+
@@ -0,0 +1,553 @@
+import functools
+import os
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import numpy as np
+from bson import ObjectId
+
+import archive
+import buckets
+import daily_index
+import recurring
+import versions
+from dates import to_naive_utc
+from versions import GLOBAL_VERSION, month_key, month_keys
+
+# Storage backends. Everything above this layer (DatabaseOperations in
+# main.py, FinanceManager in FINANCE_MANAGER.py and FinanceManager.py,
+# SummaryContext) talks to a StorageBackend instead of a pymongo database,
+# so the same logic runs against MongoDB or the in-memory columnar engine.
+#
+# Backends implement the storage primitives (the abstract methods, so a
+# backend missing one fails when instantiated); the public methods shared by
+# every backend, such as merging recurring rules into totals, live on
+# StorageBackend itself.
+
+KINDS = ("incomes", "expenses")
+
+
+class StorageBackend(ABC):
+    # Primitives
+
+    def ensure_indexes(self):
+        pass
+
+    @abstractmethod
+    def create_user(self, user: dict):
+        ...
+
+    @abstractmethod
+    def add_transaction(self, kind: str, user_id: str, transaction: dict):
+        ...
+
+    @abstractmethod
+    def add_holding(self, kind: str, user_id: str, holding: dict):
+        # Loans and investments
+        ...
+
+    @abstractmethod
+    def get_holdings(self, kind: str, user_id: str, active_on: datetime = None):
+        ...
+
+    @abstractmethod
+    def get_holdings_total(self, kind: str, user_id: str):
+        ...
+
+    @abstractmethod
+    def get_stored_monthly_total(self, kind: str, user_id: str, month: int, year: int):
+        ...
+
+    @abstractmethod
+    def get_stored_category_totals(self, user_id: str, month: int, year: int):
+        ...
+
+    @abstractmethod
+    def get_stored_transactions(self, kind: str, user_id: str, month: int, year: int):
+        ...
+
+    @abstractmethod
+    def get_stored_range_totals(self, user_id: str, start_date: datetime, end_date: datetime):
+        ...
+
+    @abstractmethod
+    def insert_recurring_rule(self, user_id: str, rule: dict):
+        ...
+
+    @abstractmethod
+    def update_recurring_rule(self, user_id: str, rule_id: str, skip: datetime = None, override: tuple = None):
+        # Record a skipped date or a (date, amount) override; returns False
+        # when the rule does not exist
+        ...
+
+    @abstractmethod
+    def get_recurring_rules(self, user_id: str, start_date: datetime, end_date: datetime, kind: str = None):
+        ...
+
+    @abstractmethod
+    def bump_version(self, user_id: str, key: int):
+        ...
+
+    @abstractmethod
+    def get_version(self, user_id: str, keys: list):
+        # Sum of the counters for `keys` plus the user's global counter
+        ...
+
+    # Shared API
+
+    def add_income(self, user_id: str, income: dict):
+        self.add_dated_transaction("incomes", user_id, income)
+
+    def add_expense(self, user_id: str, expense: dict):
+        self.add_dated_transaction("expenses", user_id, expense)
+
+    def add_dated_transaction(self, kind: str, user_id: str, transaction: dict):
+        # Every layout files a transaction under its UTC month, so the version
+        # bumped must be that month's too
+        date = to_naive_utc(transaction["date"])
+        self.add_transaction(kind, user_id, {**transaction, "date": date})
+        self.bump_version(user_id, month_key(date.year, date.month))
+
+    def add_loan(self, user_id: str, loan: dict):
+        self.add_holding("loans", user_id, loan)
+        self.bump_version(user_id, GLOBAL_VERSION)
+
+    def add_investment(self, user_id: str, investment: dict):
+        self.add_holding("investments", user_id, investment)
+        self.bump_version(user_id, GLOBAL_VERSION)
+
+    def add_recurring_rule(self, user_id: str, rule: dict):
+        recurring.validate(rule)
+        rule_id = self.insert_recurring_rule(user_id, rule)
+        self.bump_version(user_id, GLOBAL_VERSION)
+        return rule_id
+
+    def get_etag(self, user_id: str, start_date: datetime, end_date: datetime):
+        # ETag for any response computed from the user's data in [start_date, end_date)
+        return '"%d"' % self.get_version(user_id, month_keys(start_date, end_date))
+
+    def get_loans(self, user_id: str):
+        return self.get_holdings_total("loans", user_id)
+
+    def get_investments(self, user_id: str):
+        return self.get_holdings_total("investments", user_id)
+
+    def get_monthly_loan_interest(self, user_id: str):
+        loans = self.get_holdings("loans", user_id)
+        return sum(loan["amount"] * (loan["interest_rate"] / 12) for loan in loans)
+
+    def get_monthly_investment_returns(self, user_id: str):
+        investments = self.get_holdings("investments", user_id)
+        return sum(inv["amount"] * (inv["return_rate"] / 12) for inv in investments)
+
+    def get_monthly_income(self, user_id: str, month: int, year: int):
+        return self.get_monthly_total("incomes", user_id, month, year)
+
+    def get_monthly_expenses(self, user_id: str, month: int, year: int):
+        return self.get_monthly_total("expenses", user_id, month, year)
+
+    def get_monthly_total(self, kind: str, user_id: str, month: int, year: int):
+        start_date, end_date = archive.month_range(month, year)
+        rules = self.get_recurring_rules(user_id, start_date, end_date, kind)
+        return self.get_stored_monthly_total(kind, user_id, month, year) + recurring.total(rules, start_date, end_date)
+
+    def categorize_expenses(self, user_id: str, month: int, year: int):
+        categories = self.get_stored_category_totals(user_id, month, year)
+        start_date, end_date = archive.month_range(month, year)
+        rules = self.get_recurring_rules(user_id, start_date, end_date, "expenses")
+        for category, amount in recurring.category_totals(rules, start_date, end_date).items():
+            categories[category] = categories.get(category, 0) + amount
+        return categories
+
+    def get_monthly_transactions(self, kind: str, user_id: str, month: int, year: int):
+        start_date, end_date = archive.month_range(month, year)
+        rules = self.get_recurring_rules(user_id, start_date, end_date, kind)
+        return self.get_stored_transactions(kind, user_id, month, year) + recurring.transactions(rules, start_date, end_date)
+
+    def get_range_totals(self, user_id: str, start_date: datetime, end_date: datetime):
+        # Income, expenses and per-category spend for [start_date, end_date)
+        totals = self.get_stored_range_totals(user_id, start_date, end_date)
+        rules = self.get_recurring_rules(user_id, start_date, end_date)
+        income_rules = [rule for rule in rules if rule["kind"] == "incomes"]
+        expense_rules = [rule for rule in rules if rule["kind"] == "expenses"]
+        totals["income"] += recurring.total(income_rules, start_date, end_date)
+        totals["expenses"] += recurring.total(expense_rules, start_date, end_date)
+        for category, amount in recurring.category_totals(expense_rules, start_date, end_date).items():
+            totals["expense_categories"][category] = totals["expense_categories"].get(category, 0) + amount
+        return totals
+
+    def skip_recurring_occurrence(self, user_id: str, rule_id: str, date: datetime):
+        updated = self.update_recurring_rule(user_id, rule_id, skip=datetime(date.year, date.month, date.day))
+        if updated:
+            self.bump_version(user_id, GLOBAL_VERSION)
+        return updated
+
+    def override_recurring_occurrence(self, user_id: str, rule_id: str, date: datetime, amount: float):
+        updated = self.update_recurring_rule(user_id, rule_id, override=(date, amount))
+        if updated:
+            self.bump_version(user_id, GLOBAL_VERSION)
+        return updated
+
+
+class MongoBackend(StorageBackend):
+    # Incomes and expenses use either the per-transaction layout or the
+    # bucketed layout (see buckets.py); closed months may live in the archive
+    # (see archive.py) and every write feeds the daily prefix-sum index.
+    # User ids are stored as ObjectIds, or as the plain strings they arrive
+    # as when object_ids is False (FinanceManager.py always stored strings).
+    def __init__(self, db, bucketed: bool = False, object_ids: bool = True):
+        self.db = db
+        self.bucketed = bucketed
+        self.object_ids = object_ids
+
+    def user_key(self, user_id: str):
+        return ObjectId(user_id) if self.object_ids else user_id
+
+    def ensure_indexes(self):
+        for kind in KINDS:
+            self.db[kind].create_index([("user_id", 1), ("date", 1)])
+        self.db.loans.create_index([("user_id", 1)])
+        self.db.investments.create_index([("user_id", 1)])
+        if self.bucketed:
+            buckets.ensure_indexes(self.db)
+        archive.ensure_indexes(self.db)
+        daily_index.ensure_indexes(self.db)
+        recurring.ensure_indexes(self.db)
+        versions.ensure_indexes(self.db)
+
+    def create_user(self, user: dict):
+        result = self.db.users.insert_one(user)
+        return str(result.inserted_id)
+
+    def add_transaction(self, kind: str, user_id: str, transaction: dict):
+        # The index is only updated once the transaction is stored
+        if self.bucketed:
+            buckets.add_transaction(self.db[buckets.BUCKET_COLLECTIONS[kind]], self.user_key(user_id), transaction)
+        else:
+            self.db[kind].insert_one({**transaction, "user_id": self.user_key(user_id)})
+        daily_index.record(self.db, self.user_key(user_id), kind, transaction)
+
+    def add_holding(self, kind: str, user_id: str, holding: dict):
+        self.db[kind].insert_one({**holding, "user_id": self.user_key(user_id)})
+
+    def get_holdings(self, kind: str, user_id: str, active_on: datetime = None):
+        query = {"user_id": self.user_key(user_id)}
+        if active_on is not None:
+            query["end_date"] = {"$gte": active_on}
+        return list(self.db[kind].find(query))
+
+    # Pipeline builders, shared with check_query_plans.py so the plans it
+    # checks are exactly the ones served
+
+    def holdings_total_pipeline(self, user_id: str):
+        return [
+            {"$match": {"user_id": self.user_key(user_id)}},
+            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+        ]
+
+    def monthly_total_pipeline(self, user_id: str, month: int, year: int):
+        start_date, end_date = archive.month_range(month, year)
+        return [
+            {"$match": {
+                "user_id": self.user_key(user_id),
+                "date": {"$gte": start_date, "$lt": end_date}
+            }},
+            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+        ]
+
+    def category_totals_pipeline(self, user_id: str, month: int, year: int):
+        start_date, end_date = archive.month_range(month, year)
+        return [
+            {"$match": {
+                "user_id": self.user_key(user_id),
+                "date": {"$gte": start_date, "$lt": end_date}
+            }},
+            {"$group": {"_id": "$category", "total": {"$sum": "$amount"}}}
+        ]
+
+    def version_query(self, user_id: str, keys: list):
+        return versions.version_query(self.user_key(user_id), keys)
+
+    def get_holdings_total(self, kind: str, user_id: str):
+        result = list(self.db[kind].aggregate(self.holdings_total_pipeline(user_id)))
+        return result[0]["total"] if result else 0
+
+    def get_stored_monthly_total(self, kind: str, user_id: str, month: int, year: int):
+        if self.bucketed:
+            total = buckets.monthly_total(self.db[buckets.BUCKET_COLLECTIONS[kind]], self.user_key(user_id), month, year)
+        else:
+            result = list(self.db[kind].aggregate(self.monthly_total_pipeline(user_id, month, year)))
+            total = result[0]["total"] if result else 0
+        # Closed months may have been moved to the archive, which keeps their totals
+        if archive.is_closed(month, year):
+            archived = archive.get_totals(self.db, kind, self.user_key(user_id), month, year)
+            total += archived["total"] if archived else 0
+        return total
+
+    def get_stored_category_totals(self, user_id: str, month: int, year: int):
+        if self.bucketed:
+            categories = buckets.category_totals(self.db.expense_buckets, self.user_key(user_id), month, year)
+        else:
+            result = list(self.db.expenses.aggregate(self.category_totals_pipeline(user_id, month, year)))
+            categories = {item["_id"]: item["total"] for item in result}
+        if archive.is_closed(month, year):
+            for category, amount in archive.get_category_totals(self.db, "expenses", self.user_key(user_id), month, year).items():
+                categories[category] = categories.get(category, 0) + amount
+        return categories
+
+    def get_stored_transactions(self, kind: str, user_id: str, month: int, year: int):
+        if self.bucketed:
+            bucket_docs = self.db[buckets.BUCKET_COLLECTIONS[kind]].find(
+                {"user_id": self.user_key(user_id), "year": year, "month": month},
+                {"transactions": 1, "_id": 0}
+            )
+            transactions = [transaction for bucket in bucket_docs for transaction in bucket["transactions"]]
+        else:
+            start_date, end_date = archive.month_range(month, year)
+            transactions = list(self.db[kind].find(
+                {"user_id": self.user_key(user_id), "date": {"$gte": start_date, "$lt": end_date}},
+                {"_id": 0, "user_id": 0}
+            ))
+        if archive.is_closed(month, year):
+            transactions = archive.get_transactions(self.db, kind, self.user_key(user_id), month, year) + transactions
+        return transactions
+
+    def get_stored_range_totals(self, user_id: str, start_date: datetime, end_date: datetime):
+        return daily_index.range_totals(self.db, self.user_key(user_id), start_date, end_date)
+
+    def insert_recurring_rule(self, user_id: str, rule: dict):
+        result = self.db[recurring.RULES_COLLECTION].insert_one({**rule, "user_id": self.user_key(user_id)})
+        return str(result.inserted_id)
+
+    def update_recurring_rule(self, user_id: str, rule_id: str, skip: datetime = None, override: tuple = None):
+        update = {}
+        if skip is not None:
+            update["$addToSet"] = {"skips": skip}
+        if override is not None:
+            update["$set"] = {recurring.override_key(override[0]): override[1]}
+        result = self.db[recurring.RULES_COLLECTION].update_one(
+            {"_id": ObjectId(rule_id), "user_id": self.user_key(user_id)}, update
+        )
+        return result.matched_count > 0
+
+    def get_recurring_rules(self, user_id: str, start_date: datetime, end_date: datetime, kind: str = None):
+        query = recurring.rules_filter(self.user_key(user_id), start_date, end_date)
+        if kind is not None:
+            query["kind"] = kind
+        return list(self.db[recurring.RULES_COLLECTION].find(query))
+
+    def bump_version(self, user_id: str, key: int):
+        versions.bump(self.db, self.user_key(user_id), key)
+
+    def get_version(self, user_id: str, keys: list):
+        return versions.get(self.db, self.user_key(user_id), keys)
+
+
+class ColumnStore:
+    # One user's incomes or expenses as parallel NumPy columns. Rows are kept
+    # sorted by date (re-sorted lazily after an out-of-order append) so any
+    # date range maps to a contiguous slice found with searchsorted, and the
+    # prefix sums of the amount column turn range totals into a subtraction.
+    def __init__(self):
+        self.size = 0
+        self.dates = np.empty(64, dtype="datetime64[us]")
+        self.amounts = np.empty(64, dtype=np.float64)
+        self.codes = np.empty(64, dtype=np.int32)
+        self.extras = []  # non-numeric fields (e.g. source), only used for listings
+        self.is_sorted = True
+        self.prefix = None
+
+    def append(self, date: datetime, amount: float, code: int, extra: dict):
+        if self.size == len(self.dates):
+            capacity = 2 * self.size
+            self.dates = np.resize(self.dates, capacity)
+            self.amounts = np.resize(self.amounts, capacity)
+            self.codes = np.resize(self.codes, capacity)
+        date = np.datetime64(to_naive_utc(date), "us")
+        if self.size and date < self.dates[self.size - 1]:
+            self.is_sorted = False
+        self.dates[self.size] = date
+        self.amounts[self.size] = amount
+        self.codes[self.size] = code
+        self.extras.append(extra)
+        self.size += 1
+        self.prefix = None
+
+    def _sort(self):
+        if self.is_sorted:
+            return
+        order = np.argsort(self.dates[:self.size], kind="stable")
+        self.dates[:self.size] = self.dates[:self.size][order]
+        self.amounts[:self.size] = self.amounts[:self.size][order]
+        self.codes[:self.size] = self.codes[:self.size][order]
+        self.extras = [self.extras[i] for i in order]
+        self.is_sorted = True
+
+    def bounds(self, start_date: datetime, end_date: datetime):
+        self._sort()
+        dates = self.dates[:self.size]
+        low = np.searchsorted(dates, np.datetime64(to_naive_utc(start_date), "us"), side="left")
+        high = np.searchsorted(dates, np.datetime64(to_naive_utc(end_date), "us"), side="left")
+        return low, high
+
+    def total(self, start_date: datetime, end_date: datetime):
+        low, high = self.bounds(start_date, end_date)
+        if self.prefix is None:
+            self.prefix = np.concatenate(([0.0], np.cumsum(self.amounts[:self.size])))
+        return float(self.prefix[high] - self.prefix[low])
+
+    def code_totals(self, start_date: datetime, end_date: datetime, categories: int):
+        low, high = self.bounds(start_date, end_date)
+        return np.bincount(self.codes[low:high], weights=self.amounts[low:high], minlength=categories)
+
+    def rows(self, start_date: datetime, end_date: datetime):
+        low, high = self.bounds(start_date, end_date)
+        return [
+            {**self.extras[i], "amount": float(self.amounts[i]), "date": self.dates[i].astype(datetime)}
+            for i in range(low, high)
+        ]
+
+
+def synchronized(method):
+    # The API runs backend calls in a threadpool; reads also mutate the
+    # column stores (lazy sort, prefix sums), so every call takes the lock
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class MemoryBackend(StorageBackend):
+    # In-memory columnar engine for analytics workers, tests and benchmarks.
+    # Nothing is persisted and the process owns all data.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.columns = {kind: {} for kind in KINDS}
+        self.holdings = {"loans": {}, "investments": {}}
+        self.rules = {}
+        self.versions = {}
+        self.categories = []
+        self.category_codes = {}
+
+    def _category_code(self, category: str):
+        if category not in self.category_codes:
+            self.category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        return self.category_codes[category]
+
+    def _store(self, kind: str, user_id: str):
+        return self.columns[kind].setdefault(user_id, ColumnStore())
+
+    def _category_totals(self, user_id: str, start_date: datetime, end_date: datetime):
+        store = self.columns["expenses"].get(user_id)
+        if store is None:
+            return {}
+        totals = store.code_totals(start_date, end_date, len(self.categories))
+        return {self.categories[code]: float(totals[code]) for code in np.flatnonzero(totals)}
+
+    @synchronized
+    def create_user(self, user: dict):
+        user_id = uuid.uuid4().hex
+        self.users[user_id] = dict(user)
+        return user_id
+
+    @synchronized
+    def add_transaction(self, kind: str, user_id: str, transaction: dict):
+        extra = {key: value for key, value in transaction.items() if key not in ("amount", "date")}
+        code = self._category_code(transaction["category"]) if "category" in transaction else 0
+        self._store(kind, user_id).append(transaction["date"], transaction["amount"], code, extra)
+
+    @synchronized
+    def add_holding(self, kind: str, user_id: str, holding: dict):
+        self.holdings[kind].setdefault(user_id, []).append(dict(holding))
+
+    @synchronized
+    def get_holdings(self, kind: str, user_id: str, active_on: datetime = None):
+        holdings = self.holdings[kind].get(user_id, [])
+        if active_on is not None:
+            holdings = [item for item in holdings if item.get("end_date") is not None and item["end_date"] >= active_on]
+        return list(holdings)
+
+    @synchronized
+    def get_holdings_total(self, kind: str, user_id: str):
+        return sum(item["amount"] for item in self.holdings[kind].get(user_id, []))
+
+    @synchronized
+    def get_stored_monthly_total(self, kind: str, user_id: str, month: int, year: int):
+        store = self.columns[kind].get(user_id)
+        return store.total(*archive.month_range(month, year)) if store is not None else 0
+
+    @synchronized
+    def get_stored_category_totals(self, user_id: str, month: int, year: int):
+        return self._category_totals(user_id, *archive.month_range(month, year))
+
+    @synchronized
+    def get_stored_transactions(self, kind: str, user_id: str, month: int, year: int):
+        store = self.columns[kind].get(user_id)
+        return store.rows(*archive.month_range(month, year)) if store is not None else []
+
+    @synchronized
+    def get_stored_range_totals(self, user_id: str, start_date: datetime, end_date: datetime):
+        totals = {"income": 0, "expenses": 0}
+        for kind, field in daily_index.FIELDS.items():
+            store = self.columns[kind].get(user_id)
+            if store is not None:
+                totals[field] = store.total(start_date, end_date)
+        totals["expense_categories"] = self._category_totals(user_id, start_date, end_date)
+        return totals
+
+    @synchronized
+    def insert_recurring_rule(self, user_id: str, rule: dict):
+        rule_id = uuid.uuid4().hex
+        self.rules[rule_id] = {
+            **rule,
+            "_id": rule_id,
+            "user_id": user_id,
+            "start_date": to_naive_utc(rule["start_date"]),
+            "end_date": to_naive_utc(rule["end_date"]) if rule.get("end_date") is not None else None
+        }
+        return rule_id
+
+    @synchronized
+    def update_recurring_rule(self, user_id: str, rule_id: str, skip: datetime = None, override: tuple = None):
+        rule = self.rules.get(rule_id)
+        if rule is None or rule["user_id"] != user_id:
+            return False
+        # Replace rather than mutate, rules handed out earlier may still be expanding
+        if skip is not None and skip not in rule.get("skips", []):
+            rule["skips"] = rule.get("skips", []) + [skip]
+        if override is not None:
+            rule["overrides"] = {**rule.get("overrides", {}), override[0].strftime("%Y-%m-%d"): override[1]}
+        return True
+
+    @synchronized
+    def get_recurring_rules(self, user_id: str, start_date: datetime, end_date: datetime, kind: str = None):
+        start_date, end_date = to_naive_utc(start_date), to_naive_utc(end_date)
+        return [
+            rule for rule in self.rules.values()
+            if rule["user_id"] == user_id
+            and (kind is None or rule["kind"] == kind)
+            and rule["start_date"] < end_date
+            and (rule.get("end_date") is None or rule["end_date"] >= start_date)
+        ]
+
+    @synchronized
+    def bump_version(self, user_id: str, key: int):
+        self.versions[user_id, key] = self.versions.get((user_id, key), 0) + 1
+
+    @synchronized
+    def get_version(self, user_id: str, keys: list):
+        return sum(self.versions.get((user_id, key), 0) for key in keys + [GLOBAL_VERSION])
+
+
+def from_env(db, object_ids: bool = True):
+    # STORAGE_BACKEND=memory selects the in-memory engine; otherwise MongoDB,
+    # with STORAGE_LAYOUT=bucket selecting the bucketed layout
+    if os.environ.get("STORAGE_BACKEND", "mongo") == "memory":
+        return MemoryBackend()
+    bucketed = os.environ.get("STORAGE_LAYOUT", "document") == "bucket"
+    return MongoBackend(db, bucketed=bucketed, object_ids=object_ids)
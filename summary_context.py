@@ -0,0 +1,61 @@
+from functools import cached_property
+
+
+class SummaryContext:
+    # Per-request summary graph. Every attribute below is a node that is
+    # evaluated lazily on first access and memoized for the rest of the
+    # request, so each base quantity hits the database at most once no matter
+    # how many derived metrics depend on it.
+    #
+    # `ops` is any object exposing get_monthly_income, categorize_expenses,
+    # get_loans and get_investments with the signatures used by
+    # FinanceManager / DatabaseOperations.
+    def __init__(self, ops, user_id: str, month: int, year: int):
+        self.ops = ops
+        self.user_id = user_id
+        self.month = month
+        self.year = year
+
+    # Base nodes: one query each
+    @cached_property
+    def income(self):
+        return self.ops.get_monthly_income(self.user_id, self.month, self.year)
+
+    @cached_property
+    def expense_categories(self):
+        return self.ops.categorize_expenses(self.user_id, self.month, self.year)
+
+    @cached_property
+    def loans(self):
+        return self.ops.get_loans(self.user_id)
+
+    @cached_property
+    def investments(self):
+        return self.ops.get_investments(self.user_id)
+
+    # Derived nodes
+    @cached_property
+    def expenses(self):
+        # The per-category totals already cover every expense of the month,
+        # so the monthly total is derived from them instead of re-querying.
+        return sum(self.expense_categories.values())
+
+    @cached_property
+    def loan_payments(self):
+        return self.loans
+
+    @cached_property
+    def investment_returns(self):
+        return self.investments
+
+    @cached_property
+    def net_return(self):
+        return self.income - self.expenses + self.investment_returns - self.loan_payments
+
+    @cached_property
+    def yearly_projection(self):
+        return self.net_return * 12
+
+    @cached_property
+    def min_profit_to_avoid_loss(self):
+        return (self.expenses * 12) / 12
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from contextlib import AsyncExitStack
+
+import pytest
+
+import admission
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    for name in ("ADMISSION_CAPACITY", "ADMISSION_SUMMARY_LIMIT", "ADMISSION_MAX_QUEUE", "ADMISSION_WRITE_RESERVED"):
+        monkeypatch.delenv(name, raising=False)
+    return admission.from_env()
+
+
+async def hold(stack: AsyncExitStack, controller, name: str, count: int):
+    for _ in range(count):
+        await stack.enter_async_context(controller.admit(name))
+
+
+@pytest.mark.parametrize("reads, summaries", [(4, 8), (0, 12), (6, 6)])
+def test_writes_get_through_when_reads_and_summaries_are_at_their_limits(controller, reads, summaries):
+    async def scenario():
+        async with AsyncExitStack() as stack:
+            await hold(stack, controller, "read", reads)
+            await hold(stack, controller, "summary", summaries)
+
+            # Reads and summaries have used every slot they may share...
+            queued = asyncio.ensure_future(hold(stack, controller, "read", 1))
+            await asyncio.sleep(0.01)
+            assert not queued.done()
+            assert controller.metrics()["queue_depth"]["read"] == 1
+
+            # ...but writes still start at once, up to the reserved slots
+            async with AsyncExitStack() as writes:
+                await asyncio.wait_for(hold(writes, controller, "write", controller.reserved), 0.1)
+                assert controller.metrics()["active"]["write"] == controller.reserved
+            queued.cancel()
+
+    asyncio.run(scenario())
+    assert controller.metrics()["active"] == {"write": 0, "read": 0, "summary": 0}
+
+
+def test_freed_shared_slot_goes_to_queued_read(controller):
+    async def scenario():
+        async with AsyncExitStack() as stack:
+            summaries = AsyncExitStack()
+            await hold(summaries, controller, "summary", 12)
+            queued = asyncio.ensure_future(hold(stack, controller, "read", 1))
+            await asyncio.sleep(0.01)
+            assert not queued.done()
+            await summaries.aclose()
+            await asyncio.wait_for(queued, 0.1)
+            assert controller.metrics()["active"]["read"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_slot_granted_as_deadline_passes_is_returned(controller, monkeypatch):
+    holder = AsyncExitStack()
+
+    # Newer wait_for implementations can raise TimeoutError even though the
+    # future was resolved by _release() in the meantime
+    async def wait_for(future, timeout):
+        await holder.aclose()
+        assert future.done()
+        raise asyncio.TimeoutError
+
+    async def scenario():
+        await hold(holder, controller, "write", controller.capacity)
+        monkeypatch.setattr(asyncio, "wait_for", wait_for)
+        with pytest.raises(admission.Shed) as shed:
+            async with controller.admit("write"):
+                pass
+        assert shed.value.reason == "deadline"
+
+    asyncio.run(scenario())
+    assert controller.metrics()["active"]["write"] == 0
+    assert controller.waiters == []
+
+
+def test_idle_token_buckets_are_evicted(monkeypatch):
+    monkeypatch.setattr(admission.AdmissionController, "MIN_BUCKET_SWEEP", 8)
+    controller = admission.AdmissionController(
+        capacity=4, max_queue=4,
+        route_classes={"summary": admission.RouteClass(priority=0, limit=4, deadline=1.0, rate=1000.0, burst=1)}
+    )
+
+    async def scenario():
+        for user in range(100):
+            async with controller.admit("summary", f"user-{user}"):
+                pass
+            time.sleep(0.002)
+
+    asyncio.run(scenario())
+    assert len(controller.buckets) <= 8
+
+
+def test_token_bucket_limits_one_user():
+    controller = admission.AdmissionController(
+        capacity=4, max_queue=4,
+        route_classes={"summary": admission.RouteClass(priority=0, limit=4, deadline=1.0, rate=0.001, burst=2)}
+    )
+
+    async def scenario():
+        for _ in range(2):
+            async with controller.admit("summary", "user"):
+                pass
+        with pytest.raises(admission.Shed) as shed:
+            async with controller.admit("summary", "user"):
+                pass
+        assert shed.value.status_code == 429
+        async with controller.admit("summary", "other"):
+            pass
+
+    asyncio.run(scenario())
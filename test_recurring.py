@@ -0,0 +1,105 @@
+from datetime import datetime
+
+import pytest
+from pydantic import ValidationError
+
+import recurring
+from main import RecurringRule
+
+
+def rule(**fields):
+    return {"_id": "rule", "kind": "expenses", "amount": 10.0, "frequency": "monthly", "interval": 1,
+            "category": "rent", "start_date": datetime(2024, 1, 1), "end_date": None, **fields}
+
+
+def dates(rule, start, end):
+    return [str(date) for date in recurring.occurrence_dates(rule, start, end)]
+
+
+def test_monthly_clamps_to_end_of_shorter_months():
+    monthly = rule(start_date=datetime(2024, 1, 31))
+    assert dates(monthly, datetime(2024, 1, 1), datetime(2024, 5, 1)) == [
+        "2024-01-31", "2024-02-29", "2024-03-31", "2024-04-30"
+    ]
+    assert dates(monthly, datetime(2025, 2, 1), datetime(2025, 3, 1)) == ["2025-02-28"]
+
+
+def test_yearly_on_leap_day():
+    yearly = rule(frequency="yearly", start_date=datetime(2024, 2, 29))
+    assert dates(yearly, datetime(2024, 1, 1), datetime(2029, 1, 1)) == [
+        "2024-02-29", "2025-02-28", "2026-02-28", "2027-02-28", "2028-02-29"
+    ]
+
+
+def test_weekly_stays_aligned_to_start_date():
+    # 2024-01-03 is a Wednesday; a window starting on another weekday must
+    # not shift the occurrences
+    weekly = rule(frequency="weekly", start_date=datetime(2024, 1, 3))
+    assert dates(weekly, datetime(2024, 1, 5), datetime(2024, 1, 25)) == [
+        "2024-01-10", "2024-01-17", "2024-01-24"
+    ]
+    fortnightly = rule(frequency="weekly", interval=2, start_date=datetime(2024, 1, 3))
+    assert dates(fortnightly, datetime(2024, 1, 5), datetime(2024, 2, 1)) == ["2024-01-17", "2024-01-31"]
+    assert dates(fortnightly, datetime(2024, 1, 17), datetime(2024, 1, 18)) == ["2024-01-17"]
+
+
+def test_monthly_interval_skips_months_before_window():
+    quarterly = rule(interval=3, start_date=datetime(2024, 1, 15))
+    assert dates(quarterly, datetime(2024, 2, 1), datetime(2025, 1, 1)) == [
+        "2024-04-15", "2024-07-15", "2024-10-15"
+    ]
+
+
+def test_end_date_is_inclusive():
+    daily = rule(frequency="daily", start_date=datetime(2024, 1, 1), end_date=datetime(2024, 1, 3))
+    assert dates(daily, datetime(2023, 12, 1), datetime(2024, 2, 1)) == ["2024-01-01", "2024-01-02", "2024-01-03"]
+
+
+def test_skips_and_overrides():
+    monthly = rule(
+        skips=[datetime(2024, 2, 1)],
+        overrides={"2024-03-01": 25.0, "2024-02-01": 99.0, "2024-03-02": 50.0}
+    )
+    start, end = datetime(2024, 1, 1), datetime(2024, 5, 1)
+    occurrences, amounts = recurring.expand(monthly, start, end)
+    assert [str(date) for date in occurrences] == ["2024-01-01", "2024-03-01", "2024-04-01"]
+    # An override on a skipped date or on a day without an occurrence is ignored
+    assert amounts.tolist() == [10.0, 25.0, 10.0]
+    assert recurring.total([monthly], start, end) == 45.0
+
+
+def test_category_totals_and_transactions():
+    rent = rule(overrides={"2024-02-01": 12.0})
+    salary = rule(kind="incomes", source="job", category=None, amount=100.0, start_date=datetime(2024, 1, 15))
+    start, end = datetime(2024, 1, 1), datetime(2024, 3, 1)
+    assert recurring.category_totals([rent], start, end) == {"rent": 22.0}
+    rows = recurring.transactions([rent, salary], start, end)
+    assert [(row["date"].day, row["amount"]) for row in rows] == [(1, 10.0), (15, 100.0), (1, 12.0), (15, 100.0)]
+    assert rows[0]["category"] == "rent" and rows[1]["source"] == "job"
+
+
+def test_empty_window():
+    assert dates(rule(), datetime(2023, 1, 1), datetime(2023, 12, 1)) == []
+    occurrences, amounts = recurring.expand(rule(overrides={"2023-06-01": 5.0}), datetime(2023, 1, 1), datetime(2023, 12, 1))
+    assert len(occurrences) == 0 and len(amounts) == 0
+
+
+@pytest.mark.parametrize("fields", [
+    {"interval": 0},
+    {"interval": -1},
+    {"frequency": "hourly"},
+    {"end_date": datetime(2023, 12, 31)},
+    {"category": None},
+    {"kind": "incomes", "category": None, "source": ""},
+])
+def test_invalid_rules_are_rejected(fields):
+    with pytest.raises(ValueError):
+        recurring.validate(rule(**fields))
+    model_fields = {key: value for key, value in rule(**fields).items() if key != "_id"}
+    with pytest.raises(ValidationError):
+        RecurringRule(**model_fields)
+
+
+def test_valid_rules_are_accepted():
+    recurring.validate(rule())
+    recurring.validate(rule(kind="incomes", category=None, source="salary", end_date=datetime(2024, 1, 1)))
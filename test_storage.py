@@ -0,0 +1,276 @@
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+
+import storage
+
+
+def memory_backend():
+    return storage.MemoryBackend()
+
+
+def mongo_backend(**options):
+    def make():
+        backend = storage.MongoBackend(mongomock.MongoClient().finance_manager, **options)
+        backend.ensure_indexes()
+        return backend
+    return make
+
+
+BACKENDS = {
+    "memory": memory_backend,
+    "mongo": mongo_backend(),
+    "mongo-bucket": mongo_backend(bucketed=True),
+    "mongo-string-ids": mongo_backend(object_ids=False),
+}
+
+
+def populate(backend):
+    user_id = backend.create_user({"username": "a", "email": "a@example.com", "password": "x"})
+    other_id = backend.create_user({"username": "b", "email": "b@example.com", "password": "x"})
+    backend.add_income(user_id, {"amount": 1000.0, "source": "salary", "date": datetime(2024, 1, 25)})
+    backend.add_income(user_id, {"amount": 50.0, "source": "gift", "date": datetime(2024, 2, 3, 18, 30)})
+    # Out of order and backdated writes, a tz-aware date, and another user
+    backend.add_expense(user_id, {"amount": 30.0, "category": "food", "date": datetime(2024, 1, 20)})
+    backend.add_expense(user_id, {"amount": 12.5, "category": "food", "date": datetime(2024, 1, 2)})
+    backend.add_expense(user_id, {"amount": 7.0, "category": "fun.stuff", "date": datetime(2024, 2, 29, 23, tzinfo=timezone.utc)})
+    backend.add_expense(user_id, {"amount": 4.0, "category": "food",
+                                  "date": datetime(2024, 3, 1, 1, tzinfo=timezone(timedelta(hours=2)))})
+    backend.add_expense(other_id, {"amount": 999.0, "category": "food", "date": datetime(2024, 1, 10)})
+    backend.add_loan(user_id, {"amount": 1200.0, "interest_rate": 0.06, "lender": "bank",
+                               "start_date": datetime(2023, 1, 1), "end_date": datetime(2030, 1, 1)})
+    backend.add_investment(user_id, {"amount": 600.0, "return_rate": 0.12, "name": "fund",
+                                     "start_date": datetime(2023, 1, 1), "end_date": None})
+    rent_id = backend.add_recurring_rule(user_id, {
+        "kind": "expenses", "amount": 400.0, "frequency": "monthly", "interval": 1, "category": "rent",
+        "start_date": datetime(2024, 1, 31, tzinfo=timezone.utc), "end_date": None
+    })
+    backend.add_recurring_rule(user_id, {
+        "kind": "incomes", "amount": 20.0, "frequency": "weekly", "interval": 2, "source": "side job",
+        "start_date": datetime(2024, 1, 3), "end_date": datetime(2024, 3, 31)
+    })
+    backend.skip_recurring_occurrence(user_id, rent_id, datetime(2024, 3, 31))
+    backend.override_recurring_occurrence(user_id, rent_id, datetime(2024, 2, 29), 350.0)
+    return user_id
+
+
+def snapshot(backend, user_id):
+    def rows(kind, month, year):
+        listed = backend.get_monthly_transactions(kind, user_id, month, year)
+        return sorted(
+            (row["date"].replace(tzinfo=None), row["amount"], row.get("category"), row.get("source"))
+            for row in listed
+        )
+
+    def rounded(totals):
+        return {key: round(value, 6) if isinstance(value, float) else value for key, value in totals.items()}
+
+    range_totals = backend.get_range_totals(user_id, datetime(2024, 1, 15), datetime(2024, 3, 1))
+    return {
+        "income": [backend.get_monthly_income(user_id, month, 2024) for month in (1, 2, 3)],
+        "expenses": [backend.get_monthly_expenses(user_id, month, 2024) for month in (1, 2, 3)],
+        "categories": [backend.categorize_expenses(user_id, month, 2024) for month in (1, 2, 3)],
+        "incomes listed": [rows("incomes", month, 2024) for month in (1, 2, 3)],
+        "expenses listed": [rows("expenses", month, 2024) for month in (1, 2, 3)],
+        "range": {**rounded(range_totals), "expense_categories": rounded(range_totals["expense_categories"])},
+        "loans": backend.get_loans(user_id),
+        "investments": backend.get_investments(user_id),
+        "loan interest": backend.get_monthly_loan_interest(user_id),
+        "investment returns": backend.get_monthly_investment_returns(user_id),
+    }
+
+
+def test_backends_agree():
+    snapshots = {}
+    for name, make in BACKENDS.items():
+        backend = make()
+        snapshots[name] = snapshot(backend, populate(backend))
+    expected = snapshots.pop("memory")
+    assert expected["income"] == [1060.0, 90.0, 40.0]
+    assert expected["expenses"] == [442.5, 361.0, 0]
+    assert expected["categories"][1] == {"rent": 350.0, "fun.stuff": 7.0, "food": 4.0}
+    assert expected["range"] == {
+        "income": 1130.0, "expenses": 791.0,
+        "expense_categories": {"food": 34.0, "rent": 750.0, "fun.stuff": 7.0}
+    }
+    for name, result in snapshots.items():
+        assert result == expected, name
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_etag_changes_only_for_affected_months(name):
+    backend = BACKENDS[name]()
+    user_id = backend.create_user({"username": "a"})
+    january = (datetime(2024, 1, 1), datetime(2024, 2, 1))
+    february = (datetime(2024, 2, 1), datetime(2024, 3, 1))
+    before = backend.get_etag(user_id, *january), backend.get_etag(user_id, *february)
+    backend.add_expense(user_id, {"amount": 1.0, "category": "food", "date": datetime(2024, 1, 5)})
+    assert backend.get_etag(user_id, *january) != before[0]
+    assert backend.get_etag(user_id, *february) == before[1]
+    backend.add_loan(user_id, {"amount": 1.0, "interest_rate": 0.1, "lender": "x",
+                               "start_date": datetime(2024, 1, 1), "end_date": datetime(2025, 1, 1)})
+    assert backend.get_etag(user_id, *february) != before[1]
+
+
+def test_memory_rules_accept_tz_aware_dates():
+    backend = storage.MemoryBackend()
+    user_id = backend.create_user({"username": "a"})
+    backend.add_recurring_rule(user_id, {
+        "kind": "expenses", "amount": 5.0, "frequency": "daily", "interval": 1, "category": "coffee",
+        "start_date": datetime(2024, 1, 31, tzinfo=timezone.utc),
+        "end_date": datetime(2024, 2, 2, 12, tzinfo=timezone(timedelta(hours=2)))
+    })
+    totals = backend.get_range_totals(user_id, datetime(2024, 1, 1), datetime(2024, 3, 1, tzinfo=timezone.utc))
+    assert totals["expenses"] == 15.0
+
+
+def test_string_user_ids_are_stored_as_given():
+    backend = mongo_backend(object_ids=False)()
+    backend.db.incomes.insert_one({"user_id": "john_doe", "amount": 10.0, "source": "old", "date": datetime(2024, 1, 1)})
+    backend.add_income("john_doe", {"amount": 5.0, "source": "new", "date": datetime(2024, 1, 2)})
+    assert backend.get_monthly_income("john_doe", 1, 2024) == 15.0
+    assert backend.db.incomes.count_documents({"user_id": "john_doe"}) == 2
+
+
+def test_offline_jobs_invalidate_etags():
+    import archive
+    import daily_index
+    import migrate_to_buckets
+
+    backend = mongo_backend()()
+    user_id = backend.create_user({"username": "a"})
+    user_key = backend.user_key(user_id)
+    backend.add_income(user_id, {"amount": 1.0, "source": "x", "date": datetime(2020, 1, 5)})
+    backend.add_expense(user_id, {"amount": 1.0, "category": "food", "date": datetime(2020, 1, 5)})
+    span = (datetime(2024, 1, 1), datetime(2024, 2, 1))
+    for job in (
+        lambda: daily_index.rebuild(backend.db, user_key, {"expenses": []}),
+        lambda: migrate_to_buckets.migrate_collection(backend.db, "incomes"),
+        lambda: archive.archive_month(backend.db, "expenses", user_key, 1, 2020),
+    ):
+        before = backend.get_etag(user_id, *span)
+        job()
+        assert backend.get_etag(user_id, *span) != before
+
+
+def test_buckets_file_tz_aware_dates_under_their_utc_month():
+    backend = mongo_backend(bucketed=True)()
+    user_id = backend.create_user({"username": "a"})
+    backend.add_expense(user_id, {"amount": 7.0, "category": "food",
+                                  "date": datetime(2024, 3, 1, 1, tzinfo=timezone(timedelta(hours=2)))})
+    assert backend.get_monthly_expenses(user_id, 2, 2024) == 7.0
+    assert backend.get_monthly_expenses(user_id, 3, 2024) == 0
+    assert backend.get_monthly_transactions("expenses", user_id, 2, 2024)[0]["date"] == datetime(2024, 2, 29, 23)
+
+
+def test_migration_keeps_unmigrated_data():
+    import buckets
+    import migrate_to_buckets
+
+    db = mongo_backend()().db
+    db.incomes.insert_many([
+        {"user_id": "a", "amount": 1.0, "source": "x", "date": datetime(2024, 1, day)} for day in (1, 2)
+    ])
+    # A document inserted while the migration runs is neither migrated nor deleted
+    original_insert = db.income_buckets.insert_many
+    def insert_many(documents, *args, **kwargs):
+        db.incomes.insert_one({"user_id": "b", "amount": 5.0, "source": "late", "date": datetime(2023, 1, 1)})
+        return original_insert(documents, *args, **kwargs)
+    db.income_buckets.insert_many = insert_many
+
+    assert migrate_to_buckets.migrate_collection(db, "incomes", delete_source=True) == 2
+    assert [doc["source"] for doc in db.incomes.find()] == ["late"]
+    assert buckets.monthly_total(db.income_buckets, "a", 1, 2024) == 2.0
+
+    # Buckets written since the switch are never dropped
+    with pytest.raises(RuntimeError):
+        migrate_to_buckets.migrate_collection(db, "incomes")
+    assert db.income_buckets.count_documents({}) == 1
+
+
+def test_archive_survives_a_crash_and_drops_its_source_list():
+    import archive
+
+    for bucketed in (False, True):
+        backend = mongo_backend(bucketed=bucketed)()
+        user_id = backend.create_user({"username": "a"})
+        for day in (1, 2, 3):
+            backend.add_expense(user_id, {"amount": 10.0, "category": "food", "date": datetime(2020, 1, day)})
+        hot = backend.db["expense_buckets" if bucketed else "expenses"]
+
+        # Die between the archive upsert and the hot delete, then rerun
+        original_delete = hot.delete_many
+        def crash(*args, **kwargs):
+            raise RuntimeError("crash")
+        hot.delete_many = crash
+        with pytest.raises(RuntimeError):
+            archive.archive_month(backend.db, "expenses", backend.user_key(user_id), 1, 2020, bucketed)
+        hot.delete_many = original_delete
+        backend.add_expense(user_id, {"amount": 5.0, "category": "fun", "date": datetime(2020, 1, 9)})
+        archive.archive_month(backend.db, "expenses", backend.user_key(user_id), 1, 2020, bucketed)
+
+        archived = backend.db[archive.ARCHIVE_COLLECTION].find_one()
+        assert (archived["count"], archived["total"]) == (4, 35.0)
+        assert "sources" not in archived
+        assert hot.count_documents({}) == 0
+        assert backend.get_monthly_expenses(user_id, 1, 2020) == 35.0
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_range_summary_uses_whole_utc_days(name, monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    backend = BACKENDS[name]()
+    monkeypatch.setattr(main, "backend", backend)
+    user_id = backend.create_user({"username": "a"})
+    backend.add_expense(user_id, {"amount": 5.0, "category": "food", "date": datetime(2024, 1, 10, 8)})
+    backend.add_expense(user_id, {"amount": 7.0, "category": "food",
+                                  "date": datetime(2024, 3, 1, 1, tzinfo=timezone(timedelta(hours=2)))})
+    client = TestClient(main.app)
+
+    def expenses(start, end):
+        response = client.get(f"/user/{user_id}/range-summary", params={"start": start, "end": end})
+        assert response.status_code == 200, response.text
+        return response.json()["expenses"]
+
+    assert expenses("2024-01-10T12:00:00", "2024-01-10") == 5.0
+    assert expenses("2024-02-01", "2024-02-29") == 7.0
+    assert expenses("2024-03-01", "2024-03-31") == 0
+    assert client.get(f"/user/{user_id}/range-summary", params={"start": "2024-01-11", "end": "2024-01-10"}).status_code == 400
+
+
+def test_backend_missing_a_primitive_cannot_be_instantiated():
+    class Incomplete(storage.StorageBackend):
+        def create_user(self, user):
+            return "user"
+
+    with pytest.raises(TypeError, match="add_transaction"):
+        Incomplete()
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_etag_follows_the_utc_month(name):
+    backend = BACKENDS[name]()
+    user_id = backend.create_user({"username": "a"})
+    february = (datetime(2024, 2, 1), datetime(2024, 3, 1))
+    march = (datetime(2024, 3, 1), datetime(2024, 4, 1))
+    before = backend.get_etag(user_id, *february), backend.get_etag(user_id, *march)
+    # Feb 29 in UTC
+    backend.add_expense(user_id, {"amount": 7.0, "category": "food",
+                                  "date": datetime(2024, 3, 1, 1, tzinfo=timezone(timedelta(hours=2)))})
+    assert backend.get_etag(user_id, *february) != before[0]
+    assert backend.get_etag(user_id, *march) == before[1]
+    assert backend.get_monthly_expenses(user_id, 2, 2024) == 7.0
+
+
+@pytest.mark.parametrize("path", ["financial-summary", "incomes", "expenses"])
+@pytest.mark.parametrize("month, year", [(0, 2024), (13, 2024), (12, 0)])
+def test_out_of_range_months_are_rejected(path, month, year, monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    monkeypatch.setattr(main, "backend", storage.MemoryBackend())
+    response = TestClient(main.app).get(f"/user/u/{path}", params={"month": month, "year": year})
+    assert response.status_code == 422
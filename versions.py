@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+# Write versions: every write bumps a per-user counter for the month it
+# affects, or the per-user GLOBAL_VERSION counter for data that affects every
+# month (loans, investments, recurring rules, and offline jobs such as
+# rebuilding the daily index). Counters only ever grow, so the sum of the
+# counters covering a response changes whenever the response can.
+VERSIONS_COLLECTION = "write_versions"
+GLOBAL_VERSION = -1
+
+
+def ensure_indexes(db):
+    db[VERSIONS_COLLECTION].create_index([("user_id", 1), ("month_key", 1)], unique=True)
+
+
+def month_key(year: int, month: int):
+    return year * 12 + month - 1
+
+
+def month_keys(start_date: datetime, end_date: datetime):
+    # Month keys touched by [start_date, end_date)
+    last = end_date - timedelta(microseconds=1)
+    return list(range(month_key(start_date.year, start_date.month), month_key(last.year, last.month) + 1))
+
+
+def version_query(user_id, keys: list):
+    return {"user_id": user_id, "month_key": {"$in": keys + [GLOBAL_VERSION]}}
+
+
+def bump(db, user_id, key: int = GLOBAL_VERSION):
+    db[VERSIONS_COLLECTION].update_one(
+        {"user_id": user_id, "month_key": key}, {"$inc": {"version": 1}}, upsert=True
+    )
+
+
+def get(db, user_id, keys: list):
+    # Sum of the counters for `keys` plus the user's global counter
+    counters = db[VERSIONS_COLLECTION].find(version_query(user_id, keys), {"version": 1, "_id": 0})
+    return sum(counter["version"] for counter in counters)